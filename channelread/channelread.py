@@ -26,41 +26,498 @@ __module_description__ = "Allows enabling/disabling text-to-speech on each chann
 
 import xchat
 import subprocess
+import threading
+import Queue
 import os
+import sys
+import time
+import wave
+import hashlib
 import textwrap
 import re
+from collections import deque, defaultdict, OrderedDict
+from xml.sax.saxutils import escape
+from distutils.spawn import find_executable
+
+SPEECH_QUEUE = 200 # lines waiting to be spoken, more are dropped
+MAX_AGE = 60 # seconds, older lines are skipped
+CHARS_PER_WORD = 6 # for the speech duration of long words
+LINE_PAUSE = 0.4 # seconds espeak pauses after each line
+ESPEAK_SPEED = 175 # espeak's default words per minute
+ENGINE_CHECK = 2.0 # seconds between checks for crashed espeak processes
+LONG_WORD = 20 # characters, longer words are cut
+KEEP_WORD = 8 # characters said of a long word
+KEEP_HASH = 4 # characters said of a hexadecimal hash
+MAX_REPEAT = 3 # something repeated more is said this many times
+CACHE_DIR = os.path.expanduser('~/.xchat2/channelread-cache')
+CACHE_SIZE = 50 * 1024 * 1024 # bytes of rendered speech kept
+CACHE_SEEN = 1000 # texts said once that are remembered, the second
+                  # time they are said they are rendered and cached
+PLAYERS = (['paplay'], ['aplay', '-q'])
+
+ABBREVIATIONS = {
+    'afaik': 'as far as I know',
+    'afk': 'away from keyboard',
+    'brb': 'be right back',
+    'btw': 'by the way',
+    'fyi': 'for your information',
+    'idk': "I don't know",
+    'iirc': 'if I remember correctly',
+    'imho': 'in my humble opinion',
+    'imo': 'in my opinion',
+    'irl': 'in real life',
+    'lol': 'laughing',
+    'np': 'no problem',
+    'omg': 'oh my god',
+    'pls': 'please',
+    'plz': 'please',
+    'rofl': 'laughing',
+    'thx': 'thanks',
+    'ttyl': 'talk to you later',
+    'ty': 'thank you',
+    'wb': 'welcome back',
+}
+
+# spoken before the rest
+PRIORITY_EVENTS = (
+    'Channel Msg Hilight',
+    'Channel Action Hilight',
+    'Private Message to Dialog',
+    'Private Action to Dialog',
+)
 
 def remove_mirc_color(text, 
         _remove_re_sub=re.compile(re.escape("\x03") + 
                                   r"(?:(\d{1,2})(?:,(\d{1,2}))?)?").sub):
     return _remove_re_sub('', text)
 
+def _normalization_steps():
+    # emoji are the symbols of U+1F000 and up and the dingbats and symbols 
+    # of U+2600 to U+27BF, maybe with a variation selector
+    if sys.maxunicode > 0xffff:
+        emoji = u'[\U0001f000-\U0001ffff\u2600-\u27bf]\ufe0f?'
+    else:
+        # narrow python build, the first ones are surrogate pairs
+        emoji = u'(?:[\ud83c-\ud83e][\udc00-\udfff]|[\u2600-\u27bf])\ufe0f?'
+    abbreviations = u'|'.join(sorted(ABBREVIATIONS, key=len, reverse=True))
+    flags = re.UNICODE
+    return (
+        # formatting codes other than colors
+        (re.compile(u'[\x02\x0f\x16\x1d\x1f]'), u''),
+        # links are said as their domain
+        (re.compile(ur'\b(?:[a-z][a-z0-9+.-]*://|(?=www\.))(?:[^\s/@]*@)?'
+                    ur'(?:www\.)?([^\s/:?#]+)\S*', flags | re.IGNORECASE), 
+         u'link to \\1'),
+        # hashes and ids, spelled out otherwise
+        (re.compile(ur'\b(?=[0-9a-f]*[a-f])(?=[0-9a-f]*[0-9])([0-9a-f]{%d})'
+                    ur'[0-9a-f]{8,}\b' % KEEP_HASH, flags | re.IGNORECASE), 
+         u'\\1'),
+        # repeats, but not of digits, 1000000 is no 1000
+        (re.compile(ur'([^\s\d]{1,4}?)\1{%d,}' % MAX_REPEAT, flags), 
+         u'\\1' * MAX_REPEAT),
+        # other long words
+        (re.compile(ur'(?<!\S)(\S{%d})\S{%d,}' % (KEEP_WORD, 
+                                                  LONG_WORD - KEEP_WORD + 1),
+                    flags), u'\\1'),
+        (re.compile(u'(%s)(?:\\s*%s)+' % (emoji, emoji), flags), u'\\1'),
+        (re.compile(ur'\b(?:%s)\b' % abbreviations, flags | re.IGNORECASE),
+         lambda match: ABBREVIATIONS[match.group().lower()]),
+    )
+
+def normalize(text, _steps=_normalization_steps()):
+    """Shortens what espeak would take long to say for little meaning"""
+    # counted in characters, not utf-8 bytes
+    text = text.decode('utf-8', 'replace')
+    for regex, replacement in _steps:
+        text = regex.sub(replacement, text)
+    return text.encode('utf-8')
+
+class ContextInfo(object):
+    """
+    Caches get_info() results for the last few contexts used, a copy of
+    clutterless' ContextInfo since each plugin is a single file.
+    """
+    EVENTS = ('Change Nick', 'Your Nick Changing', 'Focus Tab', 'You Join',
+              'You Part', 'You Part with Reason', 'You Kicked', 
+              'Open Context', 'Close Context', 'Server Connected', 
+              'Disconnected')
+
+    def __init__(self, size=8):
+        self.size = size
+        self._cache = []
+        for event in self.EVENTS:
+            xchat.hook_print(event, self.invalidate, priority=xchat.PRI_HIGHEST)
+
+    def get(self, *keys):
+        """Returns a tuple with the info for keys of the current context"""
+        context = xchat.get_context()
+        cache = self._cache
+        for i, (cached, info) in enumerate(cache):
+            if cached == context:
+                if i:
+                    cache.insert(0, cache.pop(i))
+                break
+        else:
+            info = {}
+            cache.insert(0, (context, info))
+            del cache[self.size:]
+        try:
+            return info[keys]
+        except KeyError:
+            result = info[keys] = tuple(context.get_info(key) for key in keys)
+            return result
+
+    def invalidate(self, word=None, word_eol=None, userdata=None):
+        del self._cache[:]
+
+class Utterance(object):
+    """Lines waiting to be spoken, consecutive ones of a nick are joined"""
+    __slots__ = ('when', 'key', 'channel', 'nick', 'text', 'count')
+
+    def __init__(self, when, key, channel, nick, text):
+        self.when = when
+        self.key = key
+        self.channel = channel
+        self.nick = nick
+        self.text = text
+        self.count = 1
+
+class SpeechScheduler(object):
+    """
+    Chooses what espeak says next: priority lines first, then the rest
+    in order.  Lines older than max_age are skipped, and a summary of how
+    many is spoken instead, so speech is never far behind the channels.
+    """
+    def __init__(self, max_age=MAX_AGE):
+        self.max_age = max_age
+        self.urgent = deque()
+        self.normal = deque()
+        self.skipped = defaultdict(int)
+
+    def __len__(self):
+        return len(self.urgent) + len(self.normal) + len(self.skipped)
+
+    def add(self, when, key, channel, nick, text, urgent=False):
+        queue = self.urgent if urgent else self.normal
+        last = queue[-1] if queue else None
+        if last is not None and last.key == key and last.nick == nick:
+            last.text += '\n' + text
+            last.count += 1
+        else:
+            queue.append(Utterance(when, key, channel, nick, text))
+        self._prune(when)
+
+    def _prune(self, now):
+        for queue in (self.urgent, self.normal):
+            while queue and now - queue[0].when > self.max_age:
+                utterance = queue.popleft()
+                self.skipped[utterance.key, 
+                             utterance.channel] += utterance.count
+
+    def next(self, now):
+        """
+        Returns (key, text) with the next text to speak and the channel 
+        key it is from, None if there is none
+        """
+        self._prune(now)
+        if self.urgent:
+            utterance = self.urgent.popleft()
+            return utterance.key, utterance.text
+        if self.normal:
+            utterance = self.normal.popleft()
+            key, text = utterance.key, utterance.text
+        else:
+            key = text = None
+        if self.skipped:
+            # said along with the next line, or skipping could go on
+            # while the summary is spoken
+            (skipped_key, channel), count = self.skipped.popitem()
+            summary = '%d message%s skipped in %s' % (count, 
+                                                      's' * (count != 1), channel)
+            if text is None:
+                key, text = skipped_key, summary
+            else:
+                text = summary + '\n' + text
+        return None if text is None else (key, text)
+
+    def clear(self):
+        self.urgent.clear()
+        self.normal.clear()
+        self.skipped.clear()
+
+class EnginePool(object):
+    """
+    Running espeak processes, one per voice of the enabled channels, so
+    a change of voice or channel costs no startup.  Speed and pitch are
+    given with each line, as SSML prosody.  Only the writer thread uses
+    it, except for kill().
+    """
+    def __init__(self):
+        self._engines = {}
+
+    def pipe(self, voice):
+        """Returns the pipe to the espeak of voice, starting it if needed"""
+        process = self._engines.get(voice)
+        if process is None or process.poll() is not None:
+            process = self._engines[voice] = self._start(voice)
+        return process.stdin
+
+    def _start(self, voice):
+        devnull = open(os.devnull, 'w+b')
+        return subprocess.Popen(['espeak', '-m', '-v', voice],
+                                stdin=subprocess.PIPE,
+                                stdout=devnull, stderr=devnull,
+                                close_fds=True)
+
+    def maintain(self, voices):
+        """Runs an espeak for each of voices, restarting crashed ones"""
+        for voice in set(self._engines) - set(voices):
+            self.stop(voice)
+        for voice in voices:
+            try:
+                self.pipe(voice)
+            except OSError:
+                # no espeak or no such voice, tried again on next check
+                pass
+
+    def stop(self, voice):
+        process = self._engines.pop(voice)
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+    def stop_all(self):
+        for voice in list(self._engines):
+            self.stop(voice)
+
+    def kill(self):
+        """Silences all, only signals so it can be used by other threads"""
+        for process in list(self._engines.values()):
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+class SpeechCache(object):
+    """
+    Speech rendered to wav files, least recently used ones removed over
+    CACHE_SIZE.  Texts are rendered the second time they are said, so
+    only repeated ones take space, and from then on the clip is played
+    without waiting for espeak.  Only the writer thread uses it, except
+    for stop().
+    """
+    def __init__(self, directory=CACHE_DIR, size=CACHE_SIZE):
+        self.directory = directory
+        self.size = size
+        self.player = None
+        for player in PLAYERS:
+            if find_executable(player[0]):
+                self.player = player
+                break
+        self._playing = None
+        self._seen = OrderedDict()
+        # file name: size, least recently used first
+        self._clips = OrderedDict()
+        self._total = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        clips = [(os.stat(path).st_mtime, name, os.path.getsize(path))
+                 for name in os.listdir(directory) if name.endswith('.wav')
+                 for path in [os.path.join(directory, name)]]
+        for mtime, name, size in sorted(clips):
+            self._clips[name] = size
+            self._total += size
+
+    def clip(self, text, voice, speed, pitch):
+        """
+        Returns the path of the clip of text, rendering it if it was
+        seen before, or None if it is to be said by espeak
+        """
+        name = hashlib.sha1('\0'.join((text, voice, str(speed), 
+                                       str(pitch)))).hexdigest() + '.wav'
+        path = os.path.join(self.directory, name)
+        if name in self._clips:
+            size = self._clips.pop(name)
+            try:
+                os.utime(path, None)
+            except OSError:
+                # removed behind our back, it is rendered again
+                self._total -= size
+                self._seen[name] = True
+            else:
+                self._clips[name] = size
+                return path
+        if self._seen.pop(name, None) is None:
+            self._seen[name] = True
+            if len(self._seen) > CACHE_SEEN:
+                self._seen.popitem(last=False)
+            return None
+        # the text goes on stdin, as an argument it could be taken for
+        # an option
+        devnull = open(os.devnull, 'w+b')
+        render = subprocess.Popen(['espeak', '-w', path, '-v', voice,
+                                   '-s', str(speed), '-p', str(pitch)],
+                                  stdin=subprocess.PIPE, 
+                                  stdout=devnull, stderr=devnull,
+                                  close_fds=True)
+        render.communicate(text)
+        if render.returncode != 0:
+            return None
+        size = self._clips[name] = os.path.getsize(path)
+        self._total += size
+        while self._total > self.size and len(self._clips) > 1:
+            old, size = self._clips.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+        return path
+
+    def usage(self):
+        """Returns how many clips are cached and their size"""
+        return len(self._clips), self._total
+
+    def play(self, path):
+        """Starts playing the clip, returns its duration in seconds"""
+        clip = wave.open(path)
+        try:
+            duration = clip.getnframes() / float(clip.getframerate())
+        finally:
+            clip.close()
+        if self._playing is not None:
+            self._playing.poll()
+        devnull = open(os.devnull, 'w+b')
+        self._playing = subprocess.Popen(self.player + [path], 
+                                         stdout=devnull, stderr=devnull,
+                                         close_fds=True)
+        return duration
+
+    def stop(self):
+        playing = self._playing
+        if playing is not None:
+            try:
+                playing.kill()
+            except OSError:
+                pass
+
 class TextToSpeech(object):
     def __init__(self):
+        # channel key: voice, None for the default one
         self._enabled = {}
+        self._info = ContextInfo()
         for action in (
                     'Channel Action',
                     'Channel Action Hilight',
                     'Channel Message',
                     'Channel Msg Hilight',
+                    'Private Message to Dialog',
+                    'Private Action to Dialog',
                 ):
             xchat.hook_print(action, self.message, action)
         xchat.hook_command('audio', self._cmd, help=self.cmd_help())
         xchat.hook_unload(self.kill)
-        self.p = None
         self.voice = 'en-us'
         self.speed = 170
         self.pitch = 50
+        self.dropped = 0
+        # espeak talks slower than a busy channel types, so the lines are
+        # written to it by a thread and xchat never waits on the pipe.
+        # The thread only writes when espeak should have finished talking,
+        # lines wait in the scheduler
+        self.scheduler = SpeechScheduler()
+        self.engines = EnginePool()
+        # rendered speech, see /AUDIO CACHE
+        self.cache = None
+        self._busy_until = 0
+        self._next_check = 0
+        self._lines = Queue.Queue(SPEECH_QUEUE)
+        self._running = True
+        self._writer = threading.Thread(target=self._write, 
+                                        name='channelread')
+        self._writer.daemon = True
+        self._writer.start()
         
-    def relaunch(self):
-        self.kill()
-        devnull = open(os.devnull, 'w+b')
-        self.p = subprocess.Popen(['espeak', '-v', self.voice, 
-                                             '-p', str(self.pitch),
-                                             '-s', str(self.speed)],
-                                   stdin=subprocess.PIPE,
-                                   stdout=devnull, stderr=devnull,
-                                   close_fds=True)
+    def _voices(self):
+        return set(voice or self.voice for voice in self._enabled.values())
+
+    def _engines_changed(self):
+        """Has the writer thread start or stop engines now"""
+        self._next_check = 0
+        try:
+            self._lines.put_nowait(())
+        except Queue.Full:
+            pass
+
+    def _markup(self, text):
+        # espeak reads its input a line at a time, each joined line gets
+        # its own prosody
+        prosody = '<prosody rate="%d%%" pitch="%d">' % (
+            self.speed * 100 // ESPEAK_SPEED, self.pitch)
+        return ''.join(prosody + escape(line) + '</prosody>\n' 
+                       for line in text.split('\n'))
+
+    def duration(self, text):
+        """Estimates the seconds espeak takes to say text"""
+        words = max(len(text.split()), len(text) / float(CHARS_PER_WORD))
+        return (words * 60.0 / self.speed + 
+                LINE_PAUSE * (text.count('\n') + 1))
+
+    def _say(self, now, voice, text):
+        cache = self.cache
+        if cache is not None:
+            path = cache.clip(text, voice, self.speed, self.pitch)
+            if path is not None:
+                self._busy_until = now + cache.play(path) + LINE_PAUSE
+                return
+        self._busy_until = now + self.duration(text)
+        pipe = self.engines.pipe(voice)
+        pipe.write(self._markup(text))
+        pipe.flush()
+
+    def _write(self):
+        """Writer thread, feeds the scheduled lines to espeak"""
+        scheduler = self.scheduler
+        pending = None
+        while True:
+            now = time.time()
+            if now >= self._next_check:
+                self.engines.maintain(self._voices())
+                self._next_check = now + ENGINE_CHECK
+            if (pending or scheduler) and now >= self._busy_until:
+                item = pending or scheduler.next(now)
+                pending = None
+                if item is not None:
+                    key, text = item
+                    if self.cache is not None and '\n' in text:
+                        # joined lines are cached one by one
+                        text, rest = text.split('\n', 1)
+                        pending = key, rest
+                    try:
+                        self._say(now, self._enabled.get(key) or self.voice,
+                                  text)
+                    except (IOError, OSError, wave.Error):
+                        # espeak died or a clip is broken, the line is lost
+                        self._busy_until = 0
+                    continue
+            timeout = self._next_check - now
+            if pending or scheduler:
+                timeout = min(timeout, self._busy_until - now)
+            try:
+                item = self._lines.get(True, max(timeout, 0))
+            except Queue.Empty:
+                continue
+            if item is None or not self._running:
+                break
+            if item:
+                when, key, channel, nick, text, urgent = item
+                scheduler.add(when, key, channel, nick, 
+                              normalize(remove_mirc_color(text)), urgent)
+        self.engines.stop_all()
 
     def _cmd(self, word, word_eol, userdata):
         if len(word) < 2:
@@ -76,10 +533,16 @@ class TextToSpeech(object):
         return xchat.EAT_ALL
 
     def kill(self, data=None):
-        if self.p is not None and self.p.poll() is None:
-            self.p.stdin.close()
-            self.p.kill()
-            self.p.wait()
+        self._running = False
+        self.engines.kill()
+        if self.cache is not None:
+            self.cache.stop()
+        try:
+            # wakes the writer up if it is waiting for lines
+            self._lines.put_nowait(None)
+        except Queue.Full:
+            pass
+        self._writer.join(1)
 
     def cmd_help(self, command=None, *extra):
         """
@@ -100,17 +563,21 @@ class TextToSpeech(object):
                     ', '.join(cmd[4:] for cmd in dir(self) 
                              if cmd.startswith('cmd_')))
         
-    def cmd_on(self, voice):
+    def cmd_on(self, voice=None):
         """
         Syntax: /AUDIO ON [voice]
         
-        Turns on audio speech for a channel.
+        Turns on audio speech for a channel, read with voice or the
+        default one set with /AUDIO VOICE.
         """
         chan = self._get_channel()
-        if chan in self._enabled:
+        if chan in self._enabled and self._enabled[chan] == voice:
             return 'ERROR: Audio speech is already enabled for %s' % chan
-        self._enabled.add(chan)
-        return 'Audio speech enabled for %s' % chan
+        self._enabled[chan] = voice
+        self._engines_changed()
+        if voice is None:
+            return 'Audio speech enabled for %s' % chan
+        return 'Audio speech enabled for %s with voice %r' % (chan, voice)
     
     def cmd_off(self):
         """
@@ -121,7 +588,8 @@ class TextToSpeech(object):
         chan = self._get_channel()
         if chan not in self._enabled:
             return 'ERROR: Audio speech is not enabled for %s' % chan
-        self._enabled.remove(chan)
+        del self._enabled[chan]
+        self._engines_changed()
         return 'Audio speech disabled for %s' % chan
         
     def cmd_speed(self, new_speed=None):
@@ -136,7 +604,6 @@ class TextToSpeech(object):
             return 'Current speed: %d' % self.speed
         else:
             self.speed = int(new_speed)
-            self.relaunch()
             return 'Speed set to %d' % self.speed
             
     def cmd_pitch(self, new_pitch=None):
@@ -150,14 +617,14 @@ class TextToSpeech(object):
             return 'Current pitch: %d' % self.pitch
         else:
             self.pitch = int(new_pitch)
-            self.relaunch()
             return 'Pitch set to %d' % self.pitch
 
     def cmd_voice(self, new_voice=None):
         """
-        Syntax: /AUDIO VOICE [NEW_PITCH]
+        Syntax: /AUDIO VOICE [NEW_VOICE]
         
-        Use voice file of this name from espeak-data/voices
+        Use voice file of this name from espeak-data/voices, for the
+        channels turned on without a voice.
         Without parameters shows current setting.
         """
         
@@ -165,9 +632,35 @@ class TextToSpeech(object):
             return 'Current voice: %r' % self.voice
         else:
             self.voice = new_voice
-            self.relaunch()
+            self._engines_changed()
             return 'Voice set to %r' % self.voice
     
+    def cmd_cache(self, state=None):
+        """
+        Syntax: /AUDIO CACHE [ON|OFF]
+        
+        Keeps the speech of repeated texts, like bot announcements, in
+        wav files that are played instead of having espeak say them
+        again.  Needs paplay or aplay.  Without parameters shows current
+        setting.
+        """
+        if state is None:
+            if self.cache is None:
+                return 'Speech cache is off'
+            clips, size = self.cache.usage()
+            return 'Speech cache is on, %d clips in %dKB' % (clips, 
+                                                             size // 1024)
+        elif state.upper() == 'ON':
+            cache = SpeechCache()
+            if cache.player is None:
+                return 'ERROR: No paplay or aplay to play the cached speech'
+            self.cache = cache
+            return 'Speech cache turned on'
+        elif state.upper() == 'OFF':
+            self.cache = None
+            return 'Speech cache turned off'
+        return self.cmd_cache.__doc__
+
     def cmd_list(self):
         """
         Syntax: /AUDIO LIST
@@ -175,27 +668,46 @@ class TextToSpeech(object):
         Lists channels where text reading is enabled
         """
         if self._enabled:
-            return 'Speech is enabled for %s' % ', '.join(repr(x) 
-                                                for x in self._enabled)
+            return 'Speech is enabled for %s (%d lines waiting, %d dropped)' % (
+                ', '.join('%r (%s)' % (chan, voice or self.voice) 
+                          for chan, voice in sorted(self._enabled.items())), 
+                self._lines.qsize() + len(self.scheduler), self.dropped)
         return 'No channel has speech enabled'
         
+    def cmd_maxage(self, new_age=None):
+        """
+        Syntax: /AUDIO MAXAGE [SECONDS]
+        
+        Lines waiting longer than this to be spoken are skipped, and only
+        how many is said.  Without parameters shows current setting.
+        """
+        if new_age is None:
+            return 'Current maximum age: %ds' % self.scheduler.max_age
+        else:
+            self.scheduler.max_age = int(new_age)
+            return 'Maximum age set to %ds' % self.scheduler.max_age
+
     def message(self, word, word_eol, userdata):
         """Got message, speaking"""
         chan = self._get_channel()
         if chan in self._enabled:
 #            print 'DEBUG: speaking %r' % word_eol[1]
-            self.speak(word_eol[1])    
+            self.speak(word_eol[1], word[0], chan, 
+                       userdata in PRIORITY_EVENTS)
         return xchat.EAT_NONE
 
     def _get_channel(self):
-        info = xchat.get_context().get_info
-        return '@'.join(info(t) for t in ('channel', 'host'))
-
-    def speak(self, msg):
-        if self.p is None or self.p.poll() is not None:
-            self.relaunch()
-        self.p.stdin.write(remove_mirc_color(msg) + '\n')
-        self.p.stdin.flush()
+        return '@'.join(self._info.get('channel', 'host'))
+
+    def speak(self, msg, nick=None, chan=None, urgent=False):
+        if chan is None:
+            chan = self._get_channel()
+        channel = chan.rpartition('@')[0]
+        try:
+            self._lines.put_nowait((time.time(), chan, channel, nick, 
+                                    msg, urgent))
+        except Queue.Full:
+            self.dropped += 1
 
 plugin = TextToSpeech()
 print 'Plugin %s loaded - for help use /AUDIO HELP' % (__module_name__,)
@@ -31,13 +31,36 @@ __module_description__ = "Removes clutter from your conversations"
 import string
 import time
 import logging
+import logging.handlers
 import functools
 import re
 import operator
 import textwrap
 import os
+import bisect
+import gc
+import threading
 
-from collections import defaultdict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+# highest resolution clock available, for timing the callbacks
+timer = getattr(time, 'perf_counter', time.time)
+
+from array import array
+from collections import defaultdict, deque, OrderedDict
 
 try:
     import hexchat as xchat
@@ -51,20 +74,134 @@ except ImportError:
         print('XChat/HexChat not found!')
         exit(1)
 LOGFILE = os.path.expanduser(os.path.join(CONFIGDIR, 'clutterless.log'))
+DATAFILE = os.path.expanduser(os.path.join(CONFIGDIR, 'clutterless.dat'))
 DEBUG_LEVEL = logging.INFO
+LOGFILE_LEVEL = logging.INFO # DEBUG with /CLUTTER DEBUG DEBUG FILE
+LOGFILE_MAXBYTES = 5 * 1024 * 1024
+LOGFILE_BACKUPS = 3
+CLEAN_INTERVAL = 60 * 1000 # ms between sweeps of idle channels
+RESYNC_INTERVAL = 10 * 60 * 1000 # ms between user count resyncs
+NETSPLIT_DELAY = 3 * 1000 # ms of quiet before summarizing a netsplit
+SAVE_INTERVAL = 5 * 60 * 1000 # ms between saves of the tracking data
+SUPRESSED_PER_CHANNEL = 200 # supressed events kept for /CLUTTER SHOW
+SUPRESSED_TOTAL = 5000
+MEMORY_BUDGET = 8 * 1024 # KB of tracking data kept before evicting channels
+CHANNEL_BYTES = 1700 # rough memory use of an empty tracking object
+ENTRY_BYTES = 133 # and of each nick tracked in it
+CHANTYPES = '#&!+'
 
 logger = logging.getLogger('clutterless')
-logger.setLevel(logging.DEBUG)
 ch = logging.StreamHandler()
 ch.setLevel(DEBUG_LEVEL)
 formatter = logging.Formatter("[%(asctime)s] %(name)s{%(levelname)s}: %(message)s")
 ch.setFormatter(formatter)
 logger.addHandler(ch)
-fh = logging.FileHandler(LOGFILE, 'w')
-fh.setLevel(logging.DEBUG)
+fh = logging.handlers.RotatingFileHandler(LOGFILE, maxBytes=LOGFILE_MAXBYTES, 
+                                          backupCount=LOGFILE_BACKUPS)
+if os.path.getsize(LOGFILE):
+    # start every session on a fresh file, keeping the last ones
+    fh.doRollover()
+fh.setLevel(LOGFILE_LEVEL)
 formatter = logging.Formatter("[%(asctime)s] %(funcName)s(%(lineno)d) {%(levelname)s}: %(message)s")
 fh.setFormatter(formatter)
-logger.addHandler(fh)
+
+try:
+    QueueHandler = logging.handlers.QueueHandler
+    QueueListener = logging.handlers.QueueListener
+except AttributeError:
+    # python 2 has no queue handlers, the minimum of them used here
+    class QueueHandler(logging.Handler):
+        def __init__(self, queue):
+            logging.Handler.__init__(self)
+            self.queue = queue
+
+        def prepare(self, record):
+            return record
+
+        def emit(self, record):
+            try:
+                self.queue.put_nowait(self.prepare(record))
+            except Exception:
+                self.handleError(record)
+
+    class QueueListener(object):
+        def __init__(self, queue, *handlers, **kwargs):
+            self.queue = queue
+            self.handlers = handlers
+            self._thread = None
+
+        def start(self):
+            self._thread = threading.Thread(target=self._monitor, 
+                                            name='clutterless-log')
+            self._thread.daemon = True
+            self._thread.start()
+
+        def _monitor(self):
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+        def stop(self):
+            self.queue.put_nowait(None)
+            self._thread.join()
+            self._thread = None
+
+class LazyQueueHandler(QueueHandler):
+    """Queues records unformatted, leaving formatting to the listener"""
+    def prepare(self, record):
+        return record
+
+# the file is written by a background thread, the console handler stays
+# on the main thread since it prints to xchat
+qh = LazyQueueHandler(queue.Queue())
+qh.setLevel(LOGFILE_LEVEL)
+logger.addHandler(qh)
+listener = QueueListener(qh.queue, fh, respect_handler_level=True)
+listener.start()
+
+def set_log_level(handler, level):
+    """
+    Sets the level of a handler, keeping the logger level at the lowest 
+    handler level so disabled messages are not built at all.
+    """
+    handler.setLevel(level)
+    if handler is fh:
+        qh.setLevel(level)
+    logger.setLevel(min(ch.level, fh.level))
+
+def replace_file(source, target):
+    """Renames source over target, which may exist even on Windows"""
+    try:
+        replace = os.replace
+    except AttributeError:
+        # python 2
+        if os.name == 'nt' and os.path.exists(target):
+            os.remove(target)
+        replace = os.rename
+    replace(source, target)
+
+def stop_logging():
+    """Writes the queued records and detaches the handlers, on unload"""
+    listener.stop()
+    for handler in (qh, ch):
+        logger.removeHandler(handler)
+    fh.close()
+
+set_log_level(ch, DEBUG_LEVEL)
+
+class ChannelName(object):
+    """Formats a (host, channel) key as channel@host, when logged"""
+    __slots__ = ('channel',)
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def __str__(self):
+        return '@'.join(reversed(self.channel))
 
 def remove_mirc_color(text, 
         _remove_re_sub=re.compile(re.escape("\x03") + 
@@ -79,71 +216,356 @@ def split_nick(text, seps=(':', ',')):
         return m.groups()
     return (None, None)
 
+class ContextInfo(object):
+    """
+    Caches get_info() results for the last few contexts used.
+
+    xchat hands out a new object on every get_context(), but objects for
+    the same context compare equal, so the cache is a short most recently
+    used list searched by equality.  It is emptied on the events that may
+    change the info, and when tabs open or close, since a new context may
+    reuse the memory of a closed one and compare equal to it.
+    """
+    EVENTS = ('Change Nick', 'Your Nick Changing', 'Focus Tab', 'You Join',
+              'You Part', 'You Part with Reason', 'You Kicked', 
+              'Open Context', 'Close Context', 'Server Connected', 
+              'Disconnected')
+
+    def __init__(self, size=8):
+        self.size = size
+        self._cache = []
+        for event in self.EVENTS:
+            xchat.hook_print(event, self.invalidate, priority=xchat.PRI_HIGHEST)
+
+    def get(self, *keys):
+        """Returns a tuple with the info for keys of the current context"""
+        context = xchat.get_context()
+        cache = self._cache
+        for i, (cached, info) in enumerate(cache):
+            if cached == context:
+                if i:
+                    cache.insert(0, cache.pop(i))
+                break
+        else:
+            info = {}
+            cache.insert(0, (context, info))
+            del cache[self.size:]
+        try:
+            return info[keys]
+        except KeyError:
+            result = info[keys] = tuple(context.get_info(key) for key in keys)
+            return result
+
+    def invalidate(self, word=None, word_eol=None, userdata=None):
+        del self._cache[:]
+
+# change in the channel user count caused by each supressed event
+USER_DELTA = {
+    'Join': 1,
+    'Part': -1,
+    'Part with Reason': -1,
+    'Quit': -1,
+}
+
+class HookStats(object):
+    """
+    Counts and times the plugin callbacks.
+
+    Run times go to a histogram with power of two microsecond buckets, 
+    so recording costs the same however many calls are seen.  Events are
+    counted by their result, eating the event from xchat means supressed.
+    """
+    BUCKETS = 20
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        # callback name -> [calls, total seconds, max seconds, histogram]
+        self.calls = {}
+        # event -> [allowed, supressed]
+        self.events = defaultdict(lambda: [0, 0])
+
+    def record(self, name, elapsed, event=None, result=None):
+        try:
+            data = self.calls[name]
+        except KeyError:
+            data = self.calls[name] = [0, 0.0, 0.0, [0] * self.BUCKETS]
+        data[0] += 1
+        data[1] += elapsed
+        if elapsed > data[2]:
+            data[2] = elapsed
+        data[3][min(int(elapsed * 1000000).bit_length(), self.BUCKETS - 1)] += 1
+        if event is not None:
+            self.events[event][result in (xchat.EAT_XCHAT, xchat.EAT_ALL)] += 1
+
+    def timed(self, name):
+        """Decorator recording the run time of a function as name"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, timer() - start)
+            return wrapper
+        return decorator
+
+    def hook_print(self, event, callback, count=True, **kwargs):
+        """Hooks a print event, timing the callback and counting the event"""
+        name = callback.__name__
+        counted = event if count else None
+        def hook(word, word_eol, userdata):
+            start = timer()
+            result = callback(word, word_eol, userdata)
+            self.record(name, timer() - start, counted, result)
+            return result
+        return xchat.hook_print(event, hook, **kwargs)
+
+    @staticmethod
+    def _percentile(histogram, calls, perc):
+        """Returns the upper bound in microseconds of the perc percentile"""
+        needed = calls * perc / 100.0
+        count = 0
+        for bucket, n in enumerate(histogram):
+            count += n
+            if count >= needed:
+                break
+        return 1 << bucket
+
+    def report(self):
+        wall = time.time() - self.since
+        lines = ['Since {:.0f}s ago:'.format(wall)]
+        for event, (allowed, supressed) in sorted(self.events.items()):
+            total = allowed + supressed
+            lines.append('* {}: {} events, {} supressed ({:.1f}%)'.format(
+                event, total, supressed, supressed * 100.0 / total))
+        spent = 0.0
+        for name, (calls, total, top, histogram) in sorted(self.calls.items()):
+            if name != 'clean':
+                spent += total
+            lines.append('* {}(): {} calls, {:.1f}ms total, avg {:.1f}us, '
+                         'p50 <{}us, p90 <{}us, p99 <{}us, max {:.0f}us'.format(
+                name, calls, total * 1000, total * 1000000 / calls, 
+                self._percentile(histogram, calls, 50), 
+                self._percentile(histogram, calls, 90),
+                self._percentile(histogram, calls, 99), top * 1000000))
+        lines.append('* {:.1f}ms in callbacks, {:.3f}% of the time '
+                     '(clean() is part of its callers)'.format(
+            spent * 1000, spent * 100 / wall if wall else 0))
+        return '\n'.join(lines)
+
+stats = HookStats()
+
 class LastSeen(object):
+    """
+    Most recently seen users, oldest first.
+
+    Kept as a circular doubly linked list of [prev, next, nick] links plus a
+    nick -> link dict, so add, contains, rename and eviction are all O(1)
+    regardless of how many users the channel has.
+    """
+    __slots__ = ('min_users', 'perc_cut', '_root', '_map')
+
     def __init__(self, min_users, perc_cut, data=None):
         if data is None:
             data = []
         self.min_users = min_users
         self.perc_cut = perc_cut
-        self._order = data
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._map = {}
+        self.extend(data)
         self.clean()
 
     def add(self, user):
-        if user in self._order: #self._data:
-            self._order.remove(user)
-        self._order.append(user)
-    
-    def clean(self):
-        ammount = int(max(len(xchat.get_list('users')) * self.perc_cut / 100.0, 
-                      self.min_users))
-        if len(self._order) > ammount:
-            logger.debug('Cleaning {!r} from last seen, limit {!r}'.format(
-                         self._order[:-ammount], ammount))
-            del self._order[:-ammount]
+        root = self._root
+        link = self._map.get(user)
+        if link is None:
+            last = root[0]
+            last[1] = root[0] = self._map[user] = [last, root, user]
+        elif link is not root[0]:
+            # move it to the end
+            self._unlink(link)
+            last = root[0]
+            link[0] = last
+            link[1] = root
+            last[1] = root[0] = link
+
+    def _unlink(self, link):
+        link_prev, link_next, _ = link
+        link_prev[1] = link_next
+        link_next[0] = link_prev
+
+    def extend(self, users):
+        """Adds many users at once, oldest first"""
+        root = self._root
+        last = root[0]
+        links = self._map
+        for user in users:
+            if user in links:
+                root[0] = last
+                self.add(user)
+                last = root[0]
+            else:
+                last[1] = last = links[user] = [last, root, user]
+        root[0] = last
+
+    def _popoldest(self):
+        link = self._root[1]
+        self._unlink(link)
+        del self._map[link[2]]
+        return link[2]
+
+    def clean(self, users=0):
+        """Evicts the oldest users over the limit, returns them"""
+        ammount = int(max(users * self.perc_cut / 100.0, self.min_users))
+        if len(self._map) > ammount:
+            removed = [self._popoldest() 
+                       for _ in range(len(self._map) - ammount)]
+            logger.debug('Cleaning %r from last seen, limit %r', 
+                         removed, ammount)
+            return removed
+        return []
     
     def rename(self, nick1, nick2):
-        if nick1 in self._order:
-            self._order = [nick2 if nick == nick1 else nick
-                           for nick in self._order]
-            return True
-        return False
+        link = self._map.pop(nick1, None)
+        if link is None:
+            return False
+        if nick2 in self._map:
+            # keep a single entry, at the position of the renamed nick
+            self._unlink(self._map.pop(nick2))
+        link[2] = nick2
+        self._map[nick2] = link
+        return True
 
     def __iter__(self):
-        return reversed(self._order)
+        root = self._root
+        link = root[0]
+        while link is not root:
+            yield link[2]
+            link = link[0]
     
     def __contains__(self, user):
-        return user in self._order    
+        return user in self._map
 
     def __len__(self):
-        return len(self._order)
+        return len(self._map)
+
+    def snapshot(self):
+        """Returns the users oldest first, as accepted by the constructor"""
+        return list(reversed(list(self)))
 
     def __repr__(self):
-        return '<LastSeen {}>'.format(self._order)
+        return '<LastSeen {}>'.format(self.snapshot())
+
+class ExpiryQueue(object):
+    """
+    Registrations in arrival order, for expiring them oldest first.
+
+    Times and line numbers are kept in arrays, entries before `head` are 
+    done and get compacted away once they are the larger part.
+    """
+    __slots__ = ('nicks', 'times', 'linenos', 'head')
+
+    def __init__(self, nicks=(), times=(), linenos=()):
+        self.nicks = list(nicks)
+        self.times = array('d', times)
+        self.linenos = array('l', linenos)
+        self.head = 0
+
+    def append(self, nick, when, lineno):
+        self.nicks.append(nick)
+        self.times.append(when)
+        self.linenos.append(lineno)
+
+    def find(self, nick, lineno):
+        """Returns the position of a registration, or -1"""
+        i = bisect.bisect_left(self.linenos, lineno, self.head)
+        if (i < len(self.nicks) and self.linenos[i] == lineno 
+                                and self.nicks[i] == nick):
+            return i
+        return -1
+
+    def insert(self, nick, when, lineno):
+        """Adds a registration out of arrival order"""
+        i = bisect.bisect_left(self.linenos, lineno, self.head)
+        self.nicks.insert(i, nick)
+        self.times.insert(i, when)
+        self.linenos.insert(i, lineno)
+
+    def compact(self):
+        if self.head > 64 and self.head * 2 > len(self.nicks):
+            for data in (self.nicks, self.times, self.linenos):
+                del data[:self.head]
+            self.head = 0
+
+    def snapshot(self, seen):
+        """Returns the live entries as (nicks, times, linenos)"""
+        start = self.head
+        entries = [(nick, when, lineno) for nick, when, lineno 
+                   in zip(self.nicks[start:], self.times[start:], 
+                          self.linenos[start:])
+                   if seen.get(nick) == lineno]
+        if not entries:
+            return ([], array('d'), array('l'))
+        nicks, times, linenos = zip(*entries)
+        return (list(nicks), array('d', times), array('l', linenos))
+
+    def __iter__(self):
+        """Yields (nick, time, lineno) for the entries not done"""
+        for i in range(self.head, len(self.nicks)):
+            yield self.nicks[i], self.times[i], self.linenos[i]
 
 class ActiveChannel(object):
+    """
+    Tracks who has been active in a channel.
+
+    A nick is active while its last registration is within `timeout` 
+    seconds or `linecut` lines, five times that for special nicks.  Only 
+    the line number of the last registration is kept per nick, the 
+    registrations themselves are queued in arrival order (one queue for
+    normal and one for special nicks) so expiring is done from the front 
+    of the queues and only touches entries that are due.  Entries of 
+    nicks registered again later are skipped as stale.
+    """
+    __slots__ = ('timeout', 'autoclean', '_time', '_lastseen', '_lineno', 
+                 '_linecut', '_seen', '_queue', '_special_queue', '_special', 
+                 'users', 'used', '_checks')
+
     def __init__(self, timeout=300, autoclean=True, time_func=time.time, 
                        linecut=50, minlastseen=3, perclastseen=1.5):
         logger.debug('Creating new channel tracking object...')
         self.timeout = timeout
         self.autoclean = autoclean
         self._time = time_func
-        self._timeout_data = {}
 
         self._lastseen = LastSeen(minlastseen, perclastseen)
 
         self._lineno = 0
-        self._lineno_data = {}
         self._linecut = linecut
 
+        # nick -> line number of its last registration
+        self._seen = {}
+        self._queue = ExpiryQueue()
+        self._special_queue = ExpiryQueue()
+
         self._special = set()
+
+        # number of users in the channel, None until known
+        self.users = None
+        # time of the last registration
+        self.used = self._time()
         
-        self._checks = (self._lastseen, self._timeout_data, self._lineno_data, 
-                        self._special)
+        self._checks = (self._lastseen, self._seen, self._special)
 
     def register(self, nick):
         """Registers a new key"""
-        self._timeout_data[nick] = self._time()
-        self._lineno_data[nick] = self._lineno
+        self.used = self._time()
+        self._queue_for(nick).append(nick, self.used, self._lineno)
+        self._seen[nick] = self._lineno
         self._lastseen.add(nick)
         self._lineno += 1
 
@@ -151,15 +573,27 @@ class ActiveChannel(object):
         self._special.add(nick)
         self.register(nick)
 
+    def _queue_for(self, nick):
+        if nick in self._special:
+            return self._special_queue
+        return self._queue
+
+    def _entries(self):
+        """Returns (nick, time, lineno, cut multiplier) of live entries"""
+        return [(nick, when, lineno, mult) 
+                for queue, mult in ((self._queue, 1), (self._special_queue, 5))
+                for nick, when, lineno in queue
+                if self._seen.get(nick) == lineno]
+
     def info(self):
-        timeout_data = ' '.join('{}[{:.2f}]'.format(nick, time.time() - t)
-                                for nick, t
-                                in sorted(self._timeout_data.items(),
-                                          key=operator.itemgetter(1)))
-        lineno_data = ' '.join('{}[{}]'.format(nick, self._lineno - t)
-                               for nick, t
-                               in sorted(self._lineno_data.items(),
-                                         key=operator.itemgetter(1)))
+        now = time.time()
+        entries = sorted(self._entries(), key=operator.itemgetter(2))
+        timeout_data = ' '.join('{}[{:.2f}]'.format(nick, now - when)
+                                for nick, when, lineno, mult in entries
+                                if now - when <= self.timeout * mult)
+        lineno_data = ' '.join('{}[{}]'.format(nick, self._lineno - lineno)
+                               for nick, when, lineno, mult in entries
+                               if self._lineno - lineno <= self._linecut * mult)
 
         lastseen_data = ','.join(self._lastseen)
         special_data = ','.join(self._special)
@@ -167,23 +601,80 @@ class ActiveChannel(object):
         return '* Timeout(%s)\n* Lineno(%s)\n* LastSeen(%s)\n* Special(%s)' % (
                 timeout_data, lineno_data, lastseen_data, special_data)
 
+    @stats.timed('clean')
     def clean(self):
-        self._cleandict(self._timeout_data, self._time(), self.timeout)
-        self._cleandict(self._lineno_data, self._lineno, self._linecut)
-        self._lastseen.clean()
-        self._special = set(nick for nick in self._special 
-                            if any(nick in check for check in self._checks[:-1]))
-                
-    def _cleandict(self, d, base, cut):
-        for key, value in list(d.items()):
-            value = base - value
-            use_cut = cut
-            if key in self._special:
-                use_cut *= 5
-            if value > use_cut:
-                logger.debug('cleaning %s for %r>%r ', key, value, use_cut)
-                del d[key]
-        
+        removed = self._expire(self._queue, 1)
+        removed.extend(self._expire(self._special_queue, 5))
+        if self.users is not None:
+            # the count is unknown after a restore or our own join, the
+            # last seen limits depend on it
+            removed.extend(self._lastseen.clean(self.users))
+        for nick in removed:
+            if (nick in self._special and nick not in self._seen 
+                                      and nick not in self._lastseen):
+                self._special.discard(nick)
+
+    def _expire(self, queue, mult):
+        """Removes the registrations that are due, returns their nicks"""
+        timeout = self.timeout * mult
+        linecut = self._linecut * mult
+        now = self._time()
+        seen = self._seen
+        nicks, times, linenos = queue.nicks, queue.times, queue.linenos
+        removed = []
+        i = queue.head
+        while i < len(nicks):
+            nick = nicks[i]
+            lineno = linenos[i]
+            if seen.get(nick) == lineno:
+                # later entries are newer, so nothing after this one is due
+                if now - times[i] <= timeout or self._lineno - lineno <= linecut:
+                    break
+                logger.debug('cleaning %s for %r>%r and %r>%r', nick, 
+                             now - times[i], timeout, 
+                             self._lineno - lineno, linecut)
+                del seen[nick]
+                removed.append(nick)
+            i += 1
+        queue.head = i
+        queue.compact()
+        return removed
+
+    def snapshot(self):
+        """Returns the tracking data as builtin types, for persisting"""
+        return (self._lineno, self._queue.snapshot(self._seen), 
+                self._special_queue.snapshot(self._seen),
+                self._lastseen.snapshot(), list(self._special))
+
+    @classmethod
+    def restore(cls, data, **kwargs):
+        """Creates a channel tracking object from a snapshot()"""
+        lineno, queue, special_queue, lastseen, special = data
+        self = cls(**kwargs)
+        self._lineno = lineno
+        self._queue = ExpiryQueue(*queue)
+        self._special_queue = ExpiryQueue(*special_queue)
+        # the nicks are shared with the other channels by the unpickler
+        for nicks, times, linenos in (queue, special_queue):
+            self._seen.update(zip(nicks, linenos))
+        self._lastseen.extend(lastseen)
+        self._special.update(special)
+        self.used = max([times[-1] for nicks, times, linenos 
+                         in (queue, special_queue) if times] or [0])
+        return self
+
+    def sizes(self):
+        """Returns the number of tracked nicks and of queued entries"""
+        return (len(self._seen), len(self._lastseen), len(self._special),
+                len(self._queue.nicks) - self._queue.head + 
+                len(self._special_queue.nicks) - self._special_queue.head)
+
+    def footprint(self):
+        """Returns a rough estimate of the memory used, in bytes"""
+        # mostly the same nicks are in both
+        return CHANNEL_BYTES + ENTRY_BYTES * max(len(self._seen), 
+                                                 len(self._lastseen))
+
     def _autoclean(self):
         if self.autoclean:
             return self.clean()
@@ -192,6 +683,19 @@ class ActiveChannel(object):
         self._autoclean()
         return sum(len(check) for check in self._checks)
 
+    def nicks(self):
+        """Returns all the tracked nicks"""
+        nicks = set(self._lastseen)
+        for check in self._checks[1:]:
+            nicks.update(check)
+        return nicks
+
+    def filter_active(self, users):
+        """Returns the users that are active, cleaning only once"""
+        self._autoclean()
+        return [user for user in users 
+                if any(user in check for check in self._checks)]
+
     def __contains__(self, user):
         """
         checks if an user is active in the channel
@@ -199,32 +703,242 @@ class ActiveChannel(object):
         returns: True if the user has been active
         """
         self._autoclean()
+        return self.tracks(user)
+
+    def tracks(self, user):
+        """Checks if user is tracked, without cleaning first"""
         return any(user in check for check in self._checks)
 
     def rename(self, nick1, nick2):
+        if nick1 == nick2:
+            return False
         changed = self._lastseen.rename(nick1, nick2)
-        for d in (self._timeout_data, self._lineno_data):
-            if nick1 in d:
-                d[nick2] = d[nick1]
-                del d[nick1]
-                changed = True
+        queues = {nick1: self._queue_for(nick1), nick2: self._queue_for(nick2)}
         if nick1 in self._special:
             self._special.remove(nick1)
             self._special.add(nick2)
             changed = True
+        if nick1 in self._seen:
+            lineno = self._seen.pop(nick1)
+            # keep the latest registration of both nicks
+            nick = nick1
+            if self._seen.get(nick2, -1) > lineno:
+                nick, lineno = nick2, self._seen[nick2]
+            queue = queues[nick]
+            i = queue.find(nick, lineno)
+            if i == -1:
+                self._seen.pop(nick2, None)
+            else:
+                target = self._queue_for(nick2)
+                if target is queue:
+                    queue.nicks[i] = nick2
+                else:
+                    target.insert(nick2, queue.times[i], lineno)
+                    # leave the old entry stale
+                    queue.nicks[i] = None
+                self._seen[nick2] = lineno
+            changed = True
         return changed
         
+class SplitStorm(object):
+    """Quits and joins of a netsplit buffered for one channel"""
+    __slots__ = ('context', 'last', 'servers', 'quits', 'joins')
+
+    def __init__(self, context):
+        self.context = context
+        self.last = None
+        self.servers = set()
+        self.quits = []
+        self.joins = []
+
+class NetSplit(object):
+    """
+    Detects netsplits and the netjoins that follow them.
+
+    Quits with a "server1 server2" reason are buffered per channel, as are
+    the joins of users lost in a split, until no event arrives for `delay`
+    seconds.  Split users are remembered, with the channels they quit, for
+    `timeout` seconds or until their rejoin of every channel is flushed.
+    """
+    _split_match = re.compile(r'^[\w-]+(?:\.[\w-]+)+ [\w-]+(?:\.[\w-]+)+$').match
+
+    def __init__(self, delay=NETSPLIT_DELAY / 1000.0, timeout=30 * 60, 
+                       time_func=time.time):
+        self.delay = delay
+        self.timeout = timeout
+        self._time = time_func
+        self._split = defaultdict(dict)
+        self._storms = {}
+
+    def _storm(self, channel, context):
+        storm = self._storms.get(channel)
+        if storm is None:
+            storm = self._storms[channel] = SplitStorm(context)
+        storm.last = self._time()
+        return storm
+
+    def quit(self, channel, context, nick, reason):
+        """Buffers the quit if it is caused by a netsplit"""
+        if not self._split_match(reason):
+            return False
+        split = self._split[channel[0]].get(nick)
+        if split is None or self._time() - split[0] > self.timeout:
+            split = self._split[channel[0]][nick] = [0, set()]
+        split[0] = self._time()
+        split[1].add(channel)
+        storm = self._storm(channel, context)
+        storm.servers.add(reason)
+        storm.quits.append(nick)
+        return True
+
+    def join(self, channel, context, nick):
+        """Buffers the join if the user was lost in a netsplit"""
+        split = self._split.get(channel[0])
+        if not split or nick not in split:
+            return False
+        if self._time() - split[nick][0] > self.timeout:
+            del split[nick]
+            return False
+        if channel not in split[nick][1]:
+            return False
+        self._storm(channel, context).joins.append(nick)
+        return True
+
+    def rename(self, host, nick1, nick2):
+        split = self._split.get(host)
+        if split and nick1 in split:
+            split[nick2] = split.pop(nick1)
+
+    def due(self):
+        """Removes and returns (channel, storm) for the finished storms"""
+        limit = self._time() - self.delay
+        due = [(channel, storm) for channel, storm in self._storms.items()
+               if storm.last <= limit]
+        for channel, storm in due:
+            del self._storms[channel]
+            self._rejoined(channel, storm.joins)
+        return due
+
+    def _rejoined(self, channel, nicks):
+        """Forgets channel for the rejoined nicks, and nicks back everywhere"""
+        split = self._split.get(channel[0])
+        if not split:
+            return
+        for nick in nicks:
+            if nick in split:
+                split[nick][1].discard(channel)
+                if not split[nick][1]:
+                    del split[nick]
+        if not split:
+            del self._split[channel[0]]
+
+    def clean(self):
+        limit = self._time() - self.timeout
+        for host, split in list(self._split.items()):
+            for nick, (when, channels) in list(split.items()):
+                if when < limit:
+                    del split[nick]
+            if not split:
+                del self._split[host]
+
+    def __len__(self):
+        return len(self._storms)
+
+class SupressedLog(object):
+    """
+    Keeps the last supressed events of each channel.
+
+    Each channel has a ring of at most `size` events, and when more than 
+    `total` events are kept the oldest ones of the least recently active 
+    channel are dropped.  An event is stored as (time, event name, words 
+    joined by NUL), a single string being much smaller than a list of them.
+    """
+    FORMATS = {
+        'Join': '{0} ({2}) has joined {1}',
+        'Part': '{0} ({1}) has left {2}',
+        'Part with Reason': '{0} ({1}) has left {2} ({3})',
+        'Quit': '{0} has quit ({1})',
+        'Change Nick': '{0} is now known as {1}',
+    }
+
+    def __init__(self, size=SUPRESSED_PER_CHANNEL, total=SUPRESSED_TOTAL, 
+                       time_func=time.time):
+        self.size = size
+        self.total = total
+        self._time = time_func
+        self._rings = OrderedDict()
+        self._count = 0
+
+    def add(self, channel, event, word):
+        ring = self._rings.pop(channel, None)
+        if ring is None:
+            ring = deque(maxlen=self.size)
+        if len(ring) < self.size:
+            self._count += 1
+        ring.append((self._time(), event, '\0'.join(word)))
+        # reinserting keeps the channels in least recently used order
+        self._rings[channel] = ring
+        while self._count > self.total:
+            oldest = next(iter(self._rings))
+            self._rings[oldest].popleft()
+            self._count -= 1
+            if not self._rings[oldest]:
+                del self._rings[oldest]
+
+    def lines(self, channel, nick=None, count=20):
+        """Returns the last count events of channel formatted, oldest first"""
+        ring = self._rings.get(channel, ())
+        if nick is not None:
+            nick = nick.lower()
+        result = []
+        for when, event, words in reversed(ring):
+            if len(result) >= count:
+                break
+            word = words.split('\0')
+            if nick is not None:
+                nicks = word[:2] if event == 'Change Nick' else word[:1]
+                if nick not in [remove_mirc_color(w).lower() for w in nicks]:
+                    continue
+            fmt = self.FORMATS.get(event)
+            result.append('{} {}'.format(
+                time.strftime('%H:%M:%S', time.localtime(when)),
+                fmt.format(*word) if fmt else ' '.join(word)))
+        result.reverse()
+        return result
+
+    def __len__(self):
+        return self._count
+
 class JoinPartFilter(object):
     def __init__(self):
         logger.debug('Initializing...')
-        self.active = defaultdict(ActiveChannel)
+        # channel -> tracking object, for channels with activity
+        self.active = {}
+        # channels not filtered, kept apart so eviction can't enable them
+        self.disabled = set()
+        self.budget = MEMORY_BUDGET * 1024
+        self.netsplit = NetSplit()
+        self.supressed = SupressedLog()
+        self._netsplit_hook = None
+        self._dirty = False
+        # canonical (host, channel) keys
+        self._channels = {}
+        self._info = ContextInfo()
+        # host -> nick -> channels where the nick is tracked, as a tuple 
+        # while they are few since it is much smaller than a set
+        self.nicks = defaultdict(dict)
+        # allow events of users active in any channel of the network
+        self.network_wide = False
+        self.load()
+        # restored channels have no user count yet
+        self._resync()
         for action, args in (
                     ('Channel Action', [0]),
                     ('Channel Action Hilight', [0]),
                     ('DCC CHAT Offer', [0]),
                     ('Channel Message', [0]),
                 ):
-            xchat.hook_print(action, self.action, userdata=(action, args))
+            stats.hook_print(action, self.action, userdata=(action, args))
         for supressed, args in (
                     ('Join', [0]),
                     ('Part', [0]),
@@ -232,18 +946,209 @@ class JoinPartFilter(object):
                     ('Change Nick', [0, 1]),
                     ('Quit', [0]),
                 ):
-            xchat.hook_print(supressed, self.supress, userdata=(supressed, args))
+            stats.hook_print(supressed, self.supress, userdata=(supressed, args))
         
-        xchat.hook_print('Change Nick', self.rename, priority=xchat.PRI_LOW)
+        # counted by supress already
+        stats.hook_print('Change Nick', self.rename, count=False, 
+                         priority=xchat.PRI_LOW)
+        stats.hook_print('Kick', self.kick)
+        stats.hook_print('You Join', self.joined)
+        for parted in ('You Part', 'You Part with Reason', 'You Kicked'):
+            stats.hook_print(parted, self.parted)
+        stats.hook_print('Disconnected', self.disconnected)
         
-        xchat.hook_print('Your Message', self.message)
+        stats.hook_print('Your Message', self.message)
         for special in (
                     'Message Send',
                     'Channel Msg Hilight',
                 ):
-            xchat.hook_print(special, self.special, userdata=special)
+            stats.hook_print(special, self.special, userdata=special)
         
         xchat.hook_command('clutter', self._cmd, help=self.cmd_help())
+        xchat.hook_timer(CLEAN_INTERVAL, self._sweep)
+        xchat.hook_timer(RESYNC_INTERVAL, self._resync)
+        xchat.hook_timer(SAVE_INTERVAL, self._autosave)
+        xchat.hook_unload(self.unload)
+
+    def load(self, filename=DATAFILE):
+        """Restores the tracking data saved by a previous session"""
+        start = time.time()
+        # nothing here is garbage, don't let the allocations trigger 
+        # full collections
+        gc.disable()
+        try:
+            with open(filename, 'rb') as f:
+                data = pickle.load(f)
+            for channel, snapshot in data.items():
+                channel = self._channels.setdefault(channel, channel)
+                if snapshot is None:
+                    self.disabled.add(channel)
+                else:
+                    self.active[channel] = ActiveChannel.restore(snapshot)
+        except IOError:
+            return
+        except Exception as e:
+            logger.warning('Discarding unreadable %s: %s', filename, e)
+            return
+        finally:
+            gc.enable()
+        for channel, active in self.active.items():
+            for nick in active.nicks():
+                self._index(channel, nick)
+        logger.debug('Restored %d channels in %.1fms', len(data), 
+                     (time.time() - start) * 1000)
+
+    def unload(self, userdata=None):
+        self.save()
+        stop_logging()
+
+    def save(self, userdata=None, filename=DATAFILE):
+        """Writes the tracking data of all channels, atomically"""
+        data = dict((channel, active.snapshot()) 
+                    for channel, active in self.active.items())
+        # disabled channels are stored without data
+        data.update(dict.fromkeys(self.disabled))
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        replace_file(tmpname, filename)
+        self._dirty = False
+
+    def _autosave(self, userdata=None):
+        if self._dirty:
+            self.save()
+        return True
+
+    def _sweep(self, userdata=None):
+        """Periodically expires data of channels with no lookups"""
+        for active in list(self.active.values()):
+            if active.autoclean:
+                active.clean()
+        self._evict()
+        self.netsplit.clean()
+        self._clean_index()
+        return True
+
+    def _evict(self):
+        """Drops the least recently used channels beyond the memory budget"""
+        usage = [(active.used, active.footprint(), channel) 
+                 for channel, active in self.active.items()]
+        total = sum(size for used, size, channel in usage)
+        if total <= self.budget:
+            return
+        usage.sort()
+        for used, size, channel in usage:
+            if total <= self.budget:
+                break
+            logger.debug('Evicting %s, idle for %.0fs', ChannelName(channel),
+                         time.time() - used)
+            self._drop(channel)
+            total -= size
+
+    def _drop(self, channel):
+        """Forgets the tracking data of channel, if any"""
+        if self.active.pop(channel, None) is not None:
+            self._dirty = True
+        if channel not in self.disabled:
+            self._channels.pop(channel, None)
+
+    def _tracked(self, channel):
+        return channel not in self.disabled and channel[1][:1] in CHANTYPES
+
+    def _tracker(self, channel):
+        """Returns the tracking object of channel, None if not tracked"""
+        activechan = self.active.get(channel)
+        if activechan is None and self._tracked(channel):
+            logger.debug('Tracking %s', ChannelName(channel))
+            channel = self._channels.setdefault(channel, channel)
+            activechan = self.active[channel] = ActiveChannel()
+        return activechan
+
+    def _index(self, channel, nick):
+        nicks = self.nicks[channel[0]]
+        channels = nicks.get(nick, ())
+        if channel not in channels:
+            if isinstance(channels, set):
+                channels.add(channel)
+            elif len(channels) < 8:
+                nicks[nick] = channels + (channel,)
+            else:
+                nicks[nick] = set(channels)
+                nicks[nick].add(channel)
+
+    def _clean_index(self):
+        """Drops the index entries of nicks no longer tracked"""
+        for host, nicks in list(self.nicks.items()):
+            for nick, channels in list(nicks.items()):
+                channels = tuple(channel for channel in channels
+                                 if channel in self.active
+                                 and self.active[channel].tracks(nick))
+                if channels:
+                    nicks[nick] = channels
+                else:
+                    del nicks[nick]
+            if not nicks:
+                del self.nicks[host]
+
+    def _active_elsewhere(self, host, nick):
+        """Checks if nick is active in any channel of the network"""
+        nicks = self.nicks.get(host)
+        if not nicks:
+            return False
+        for channel in nicks.get(nick, ()):
+            active = self.active.get(channel)
+            if active is not None and active.tracks(nick):
+                return True
+        return False
+
+    def _flush_netsplit(self, userdata=None):
+        """Shows one summary line per channel for each finished netsplit"""
+        for channel, storm in self.netsplit.due():
+            activechan = self.active.get(channel)
+            if storm.quits:
+                servers = ', '.join(sorted(servers.replace(' ', ' <-> ') 
+                                           for servers in storm.servers))
+                storm.context.prnt('clutterless: Netsplit {}: {} quits{}'.format(
+                    servers, len(storm.quits), 
+                    self._active_summary(activechan, storm.quits)))
+            if storm.joins:
+                storm.context.prnt('clutterless: Netjoin: {} users rejoined{}'.format(
+                    len(storm.joins), 
+                    self._active_summary(activechan, storm.joins)))
+        if self.netsplit:
+            return True
+        self._netsplit_hook = None
+        return False
+
+    def _active_summary(self, activechan, nicks, limit=20):
+        if not activechan:
+            return ''
+        active = activechan.filter_active(nicks)
+        if not active:
+            return ''
+        more = ' and {} more'.format(len(active) - limit) if len(active) > limit else ''
+        return ', active: {}{}'.format(', '.join(active[:limit]), more)
+
+    def _resync(self, userdata=None):
+        """Corrects drift of the user counts from the channel list"""
+        for chan in xchat.get_list('channels'):
+            if chan.type != 2:
+                continue
+            channel = (chan.context.get_info('host'), chan.channel)
+            active = self.active.get(channel)
+            if active is not None:
+                active.users = chan.users
+        return True
+
+    def _count_users(self, activechan, delta):
+        """Keeps the user count of a channel without listing its users"""
+        if activechan.users is None:
+            # a join being printed is already in the user list, 
+            # parts, quits and kicks are not removed yet
+            activechan.users = len(xchat.get_list('users'))
+            if delta > 0:
+                return
+        activechan.users = max(activechan.users + delta, 0)
 
 
     def _cmd(self, word, word_eol, userdata):
@@ -286,23 +1191,93 @@ class JoinPartFilter(object):
         Shows clutterless stored information about current channel.
         """
         channel = self._get_channel()
-        active_channel = self.active[channel]
-        if active_channel is None:        
+        active_channel = self.active.get(channel)
+        if channel in self.disabled:
             return 'clutterless: Channel is disabled'
         elif not active_channel:
             return 'clutterless: No data on [{}]'.format('@'.join(reversed(channel)))
-        data = self.active[channel].info()           
+        data = active_channel.info()
         return 'clutterless: data for [{}]:\n{}'.format('@'.join(reversed(channel)),
                                                        data)
 
-    def cmd_debug(self, level):
+    def cmd_debug(self, level, target='CONSOLE'):
+        """
+        Syntax: /CLUTTER DEBUG {CRITICAL|ERROR|WARNING|INFO|DEBUG} [CONSOLE|FILE]
+
+        Sets the level of the debug logger, or of the log file.
+        Messages below both levels are not even formatted.
+        """
+        handler = fh if target.upper() == 'FILE' else ch
+        set_log_level(handler, logging.getLevelName(level.upper()))
+        return "clutterless: changing {} debug level to {!r}".format(
+            target.lower(), level)
+
+    def cmd_stats(self, reset=None):
+        """
+        Syntax: /CLUTTER STATS [RESET]
+
+        Shows event counts, run times of the callbacks and the size of 
+        the tracking data of the busiest channels.  RESET clears the 
+        counters.
+        """
+        if reset is not None:
+            if reset.upper() != 'RESET':
+                return self.cmd_help('stats')
+            stats.reset()
+            return 'clutterless: Statistics cleared'
+        sizes = sorted(((active.sizes(), channel) 
+                        for channel, active in self.active.items()),
+                       reverse=True)
+        totals = [sum(size[i] for size, channel in sizes) for i in range(4)]
+        lines = [stats.report(), 
+                 'Tracking {} channels: {} nicks seen, {} last seen, {} '
+                 'special, {} queued entries, {} supressed events '
+                 'kept'.format(len(sizes), *totals + [len(self.supressed)]),
+                 'Using about {}KB of the {}KB budget'.format(
+                     sum(active.footprint() for active in self.active.values())
+                     // 1024, self.budget // 1024)]
+        for size, channel in sizes[:10]:
+            lines.append('* {}: {} seen, {} last seen, {} special, '
+                         '{} queued'.format('@'.join(reversed(channel)), *size))
+        return 'clutterless: ' + '\n'.join(lines)
+
+    def cmd_show(self, nick=None, count=None):
+        """
+        Syntax: /CLUTTER SHOW [nick] [n]
+
+        Shows the last n (default 20) events supressed in the current 
+        channel, or only those of nick.
+        """
+        if count is None and nick is not None and nick.isdigit():
+            nick, count = None, nick
+        try:
+            count = int(count or 20)
+        except ValueError:
+            return self.cmd_help('show')
+        channel = self._get_channel()
+        lines = self.supressed.lines(channel, nick, count)
+        name = '@'.join(reversed(channel))
+        if not lines:
+            return 'clutterless: No supressed events{} kept for [{}]'.format(
+                ' of ' + nick if nick else '', name)
+        return 'clutterless: Supressed events on [{}]:\n{}'.format(
+            name, '\n'.join(lines))
+
+    def cmd_budget(self, size=None):
         """
-        Syntax: /CLUTTER DEBUG {CRITICAL|ERROR|WARNING|INFO|DEBUG}
+        Syntax: /CLUTTER BUDGET [KB]
 
-        Sets the level of the debug logger
+        Sets the memory available for tracking data, the least recently 
+        active channels are forgotten beyond it.  Without parameters shows
+        current setting.
         """
-        ch.setLevel(logging.getLevelName(level))
-        return "clutterless: changing debug level to {!r}".format(level)
+        if size is not None:
+            try:
+                self.budget = int(size) * 1024
+            except ValueError:
+                return self.cmd_help('budget')
+            self._evict()
+        return 'clutterless: Memory budget is {}KB'.format(self.budget // 1024)
 
     def cmd_enable(self):
         """
@@ -311,10 +1286,11 @@ class JoinPartFilter(object):
         Enable clutterless filtering for the current channel
         """
         channel = self._get_channel()
-        if self.active[channel] is not None:
+        if channel not in self.disabled:
             return 'clutterless: Channel {} is already enabled!'.format(channel)
         logger.debug("Enabling %s", channel)
-        self.active[channel] = ActiveChannel()
+        self.disabled.remove(channel)
+        self._dirty = True
         return 'clutterless: Now tracking channel {}'.format(channel)
 
     def cmd_disable(self):
@@ -324,89 +1300,169 @@ class JoinPartFilter(object):
         Disable clutterless filtering for the current channel
         """
         channel = self._get_channel()
-        if self.active[channel] is None:
+        if channel in self.disabled:
             return 'clutterless: Channel {} is already disabled!'.format(channel)
-        logger.debug("Disabling {}".format(channel))
-        self.active[channel] = None
+        logger.debug("Disabling %s", channel)
+        self._drop(channel)
+        self.disabled.add(channel)
+        self._dirty = True
         return 'clutterless: Channel {} is now disabled'.format(channel)
 
+    def cmd_network(self, state=None):
+        """
+        Syntax: /CLUTTER NETWORK [ON|OFF]
+
+        When ON, users active in any channel of the network are not 
+        filtered.  Without parameters shows current setting.
+        """
+        if state is not None:
+            self.network_wide = state.upper() == 'ON'
+        return 'clutterless: Network wide activity is {}'.format(
+            'ON' if self.network_wide else 'OFF')
+
     def _get_channel(self):
-        info = xchat.get_context().get_info
-        return tuple(info(t) for t in ('host', 'channel'))
+        channel = self._info.get('host', 'channel')
+        # share a single key object between all the places storing it
+        return self._channels.get(channel, channel)
     
     def message(self, word, word_eol, user):
         """People you talk to becomes *special* - can have more timeout"""
         nick, rest = split_nick(word[1], seps=[xchat.get_prefs('completion_suffix')])
         if nick:
             # a nick, register as special
+            nick = intern(nick)
             channel = self._get_channel()
-            activechan = self.active[self._get_channel()]
+            activechan = self._tracker(channel)
             if activechan is None:
-                logger.debug('Channel %s is disabled, ignoring conversation',
-                    '@'.join(reversed(channel)))
+                logger.debug('Channel %s is not tracked, ignoring conversation',
+                    ChannelName(channel))
                 return
             logger.debug('Talked to %r on %s, registering as special', nick, 
-                         '@'.join(reversed(channel)))
+                         ChannelName(channel))
+            self._count_users(activechan, 0)
             activechan.register_special(nick)
+            self._index(channel, nick)
+            self._dirty = True
 
     def special(self, word, word_eol, userdata):
         act = userdata
-        nick = remove_mirc_color(word[0])
+        nick = intern(remove_mirc_color(word[0]))
         channel = self._get_channel()
-        activechan = self.active[channel]
+        activechan = self._tracker(channel)
         if activechan is None:
-            logger.debug('Channel %s is disabled, ignoring conversation', 
-                '@'.join(reversed(channel)))
+            logger.debug('Channel %s is not tracked, ignoring conversation', 
+                ChannelName(channel))
             return        
-        logger.debug("%r(%d) special register on %s for %r: %r", userdata, 
-                     activechan._lineno, '@'.join(reversed(channel)), nick, 
-                     word[1:])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%r(%d) special register on %s for %r: %r", userdata, 
+                         activechan._lineno, ChannelName(channel), nick, 
+                         word[1:])
+        self._count_users(activechan, 0)
         activechan.register_special(nick)
+        self._index(channel, nick)
+        self._dirty = True
 
     def action(self, word, word_eol, userdata):
         act, nicks = userdata
         for nick in nicks:
-            nick = remove_mirc_color(word[nick])
+            nick = intern(remove_mirc_color(word[nick]))
             channel = self._get_channel()
-            activechan = self.active[channel]
+            activechan = self._tracker(channel)
             if activechan is None:
-                logger.debug('Channel %s is disabled, ignoring action', 
-                    '@'.join(reversed(channel)))
+                logger.debug('Channel %s is not tracked, ignoring action', 
+                    ChannelName(channel))
                 return
-            logger.debug("%r(%d) register on %s for %r: %r", userdata, 
-                         activechan._lineno, '@'.join(reversed(channel)), nick, 
-                         word[1:])
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%r(%d) register on %s for %r: %r", userdata, 
+                             activechan._lineno, ChannelName(channel), nick, 
+                             word[1:])
+            self._count_users(activechan, 0)
             activechan.register(nick)
+            self._index(channel, nick)
+        self._dirty = True
 
     def supress(self, word, word_eol, userdata):
         act, nicks = userdata
+        channel = self._get_channel()
+        if not self._tracked(channel):
+            logger.debug('Channel %s is not tracked, allowing message', 
+                ChannelName(channel))
+            return xchat.EAT_NONE
+        # without activity seen nobody is active, but nothing to track yet
+        activechan = self.active.get(channel)
+        if activechan is not None:
+            self._count_users(activechan, USER_DELTA.get(act, 0))
+        if act in ('Quit', 'Join'):
+            nick = intern(remove_mirc_color(word[0]))
+            if act == 'Quit':
+                buffered = self.netsplit.quit(channel, xchat.get_context(), 
+                                              nick, remove_mirc_color(word[1]))
+            else:
+                buffered = self.netsplit.join(channel, xchat.get_context(), nick)
+            if buffered:
+                logger.debug("Buffering netsplit %r on %s: %r", userdata,
+                             ChannelName(channel), word)
+                self.supressed.add(channel, act, word)
+                if self._netsplit_hook is None:
+                    self._netsplit_hook = xchat.hook_timer(NETSPLIT_DELAY, 
+                                                           self._flush_netsplit)
+                return xchat.EAT_XCHAT
         for nick in nicks:
             nick = remove_mirc_color(word[nick])
-            channel = self._get_channel()
-            activechan = self.active[channel]
-            if activechan is None:
-                logger.debug('Channel %s is disabled, allowing message', 
-                    '@'.join(reversed(channel)))
-                return xchat.EAT_NONE
-            if nick in self.active[channel]:
+            if activechan is not None and nick in activechan:
                 logger.debug("Allowing %s on %s: %r", userdata, 
-                             '@'.join(reversed(channel)), word)
+                             ChannelName(channel), word)
+                return xchat.EAT_NONE
+            elif self.network_wide and self._active_elsewhere(channel[0], nick):
+                logger.debug("Allowing %s on %s, active on the network: %r", 
+                             userdata, ChannelName(channel), word)
                 return xchat.EAT_NONE
             else:
                 logger.debug("Supressing %r on %s: %r", userdata, 
-                             '@'.join(reversed(channel)), word)
+                             ChannelName(channel), word)
+        self.supressed.add(channel, act, word)
         return xchat.EAT_XCHAT
 
+    def kick(self, word, word_eol, userdata):
+        activechan = self.active.get(self._get_channel())
+        if activechan is not None:
+            self._count_users(activechan, -1)
+
+    def joined(self, word, word_eol, userdata):
+        """Our own join - the user list is not received yet"""
+        activechan = self.active.get(self._get_channel())
+        if activechan is not None:
+            activechan.users = None
+
+    def parted(self, word, word_eol, userdata):
+        """We left the channel, its tracking data is of no use anymore"""
+        channel = self._get_channel()
+        logger.debug('Left %s, dropping its data', ChannelName(channel))
+        self._drop(channel)
+
+    def disconnected(self, word, word_eol, userdata):
+        host, = self._info.get('host')
+        logger.debug('Disconnected from %s, dropping its data', host)
+        for channel in [channel for channel in self.active 
+                        if channel[0] == host]:
+            self._drop(channel)
+        self.nicks.pop(host, None)
+
     def rename(self, word, word_eol, userdata):
         nick1 = remove_mirc_color(word[0])
-        nick2 = remove_mirc_color(word[1])
+        nick2 = intern(remove_mirc_color(word[1]))
         changes = 0
         # rename happens serverwide
-        thishost = xchat.get_context().get_info('host')
-        for (host, channel), active in self.active.items():
-            if host == thishost:
-                if active and active.rename(nick1, nick2):
-                    changes += 1
+        thishost, = self._info.get('host')
+        self.netsplit.rename(thishost, nick1, nick2)
+        nicks = self.nicks.get(thishost)
+        channels = nicks.pop(nick1, ()) if nicks else ()
+        for channel in channels:
+            active = self.active.get(channel)
+            if active and active.rename(nick1, nick2):
+                self._index(channel, nick2)
+                changes += 1
+        self._dirty = self._dirty or bool(changes)
         logger.debug("Renaming %r to %r on %s - %d channels changed",
                      nick1, nick2, thishost, changes)
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright© 2010 Clovis Fabricio Costa
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the speed and accuracy of the hybrid_decode conversion.
+
+A corpus of lines is generated from a fixed seed, like hebrew_bot's test
+command but more of them: each sender writes one language in one
+encoding, and xchat decoded everything with the 8bit CHARSET.  For each
+mix of encodings and each fallback list, prints how many lines per
+second are converted and how many come out as they were written.
+
+    python bench_decode.py [-n LINES] [-s SEED] [-r REPEAT]
+"""
+
+import os
+import sys
+import random
+import argparse
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hybrid_decode import Converter
+
+CHARSET = 'latin1' # what xchat decoded the lines with
+
+WORDS = {
+    'hebrew': u'שלום עולם מה נשמע תודה רבה בוקר טוב לילה ערב אני אתה היא '
+              u'אנחנו כן לא אולי עכשיו מחר אתמול ספר בית ילד שיר מחשב'.split(),
+    'russian': u'привет мир как дела спасибо большое доброе утро ночь вечер '
+               u'я ты она мы да нет может сейчас завтра вчера книга дом'.split(),
+    'portuguese': u'olá mundo ação não então você está até já também coração '
+                  u'amanhã ontem livro casa canção avó pão mãe irmão'.split(),
+    'english': u'hello world how are you thanks good morning night evening '
+               u'yes no maybe now tomorrow yesterday book house'.split(),
+}
+
+# (language, encoding) of each kind of sender
+SENDERS = {
+    'utf-8 hebrew': ('hebrew', 'utf-8'),
+    'cp1255 hebrew': ('hebrew', 'cp1255'),
+    'utf-8 russian': ('russian', 'utf-8'),
+    'cp1251 russian': ('russian', 'cp1251'),
+    'utf-8 latin1': ('portuguese', 'utf-8'),
+    'latin1 latin1': ('portuguese', 'latin1'),
+    'ascii': ('english', 'ascii'),
+}
+
+MIXES = (
+    ('utf-8', ['utf-8 hebrew', 'utf-8 russian', 'utf-8 latin1', 'ascii']),
+    ('hebrew', ['utf-8 hebrew', 'cp1255 hebrew', 'ascii']),
+    ('russian', ['utf-8 russian', 'cp1251 russian', 'ascii']),
+    ('latin1', ['utf-8 latin1', 'latin1 latin1', 'ascii']),
+    ('all', sorted(SENDERS)),
+)
+
+FALLBACKS = (
+    ['cp1255'],
+    ['cp1251'],
+    ['latin1'],
+    ['cp1255', 'cp1251'],
+    ['cp1255', 'cp1251', 'latin1'],
+)
+
+NICKS_PER_KIND = 5
+
+def generate(kinds, count, seed):
+    """
+    Returns count (sender, received, expected) for the senders of kinds,
+    received as given to the plugin and expected as the sender wrote it
+    """
+    rnd = random.Random(seed)
+    nicks = [(kind, ('host', '%s%d' % (kind.replace(' ', '_'), i)))
+             for kind in kinds for i in range(NICKS_PER_KIND)]
+    lines = []
+    for i in range(count):
+        kind, sender = rnd.choice(nicks)
+        language, encoding = SENDERS[kind]
+        # mostly chat sized lines, a few one worders
+        size = rnd.choice((1, 2, 3, 5, 8, 8, 13, 13, 21))
+        words = WORDS[language]
+        text = u' '.join(rnd.choice(words) for n in range(size))
+        received = text.encode(encoding).decode(CHARSET).encode('utf-8')
+        lines.append((sender, received, text.encode('utf-8')))
+    return lines
+
+def run(lines, fallbacks):
+    """Converts the lines, returns (seconds, lines converted correctly)"""
+    converter = Converter(fallbacks)
+    convert = converter.convert_piece
+    start = timer()
+    results = [convert(received, CHARSET, sender)
+               for sender, received, expected in lines]
+    elapsed = timer() - start
+    right = sum(result == expected
+                for result, (sender, received, expected) in zip(results, lines))
+    return elapsed, right
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks hybrid_decode '
+                                     'conversions on a generated corpus.')
+    parser.add_argument('-n', '--lines', type=int, default=5000,
+                        help='lines per mix (default %(default)s)')
+    parser.add_argument('-s', '--seed', type=int, default=2010,
+                        help='corpus seed (default %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per case, the fastest counts '
+                             '(default %(default)s)')
+    args = parser.parse_args(argv)
+    print '%d lines per mix, seed %d, received as %s' % (args.lines,
+                                                         args.seed, CHARSET)
+    print '%-8s %-22s %10s %9s' % ('mix', 'fallbacks', 'lines/s', 'accuracy')
+    for name, kinds in MIXES:
+        lines = generate(kinds, args.lines, args.seed)
+        for fallbacks in FALLBACKS:
+            elapsed, right = min(run(lines, fallbacks)
+                                 for i in range(args.repeat))
+            print '%-8s %-22s %10.0f %8.1f%%' % (name, ','.join(fallbacks),
+                len(lines) / elapsed, 100.0 * right / len(lines))
+
+if __name__ == '__main__':
+    main()
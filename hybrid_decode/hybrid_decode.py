@@ -52,78 +52,433 @@ MSG_WRONGENC =("hybrid: CHARSET is %r which doesn't support full 8bit "
                'before loading the plugin to prevent this message on the '
                'future.')
 
+# event, arguments to convert, argument with the sender nick (if any)
 EVENTS = [
-  ("Channel Action", [1]),
-  ("Channel Action Hilight", [1]),
-  ("Channel Message", [1]),
-  ("Channel Msg Hilight", [1]),
-  ("Channel Notice", [2]),
-  ("Generic Message", [0, 1]),
-  ("Kick", [3]),
-  ("Killed", [1]),
-  ("Motd", [0]),
-  ("Notice", [1]),
-  ("Part with Reason", [3]),
-  ("Private Message", [1]),
-  ("Private Message to Dialog", [1]),
-  ("Quit", [1]),
-  ("Receive Wallops", [1]),
-  ("Server Notice", [0]),
-  ("Server Text", [0]),
-  ("Topic", [1]),
-  ("Topic Change", [1]),
+  ("Channel Action", [1], 0),
+  ("Channel Action Hilight", [1], 0),
+  ("Channel Message", [1], 0),
+  ("Channel Msg Hilight", [1], 0),
+  ("Channel Notice", [2], 0),
+  ("Generic Message", [0, 1], None),
+  ("Kick", [3], 0),
+  ("Killed", [1], 0),
+  ("Motd", [0], None),
+  ("Notice", [1], 0),
+  ("Part with Reason", [3], 0),
+  ("Private Message", [1], 0),
+  ("Private Message to Dialog", [1], 0),
+  ("Quit", [1], 0),
+  ("Receive Wallops", [1], 0),
+  ("Server Notice", [0], None),
+  ("Server Text", [0], None),
+  ("Topic", [1], None),
+  ("Topic Change", [1], 0),
 ]
 
-import xchat
+# server commands whose last parameter is repaired in server mode
+SERVER_EVENTS = ('PRIVMSG', 'NOTICE', 'TOPIC', 'QUIT', 'KICK', 'PART', '332')
+
+# repair the raw server lines instead of the printed events, so the line
+# is converted once, before xchat and the other plugins handle it
+SERVER_MODE = True
+
+MEMO_SIZE = 1000 # senders whose encoding is remembered
+
+LINE_LIMIT = 512 # bytes per line sent, including the CRLF
+# the prefix the server relays our lines with, ":nick!user@host ", with
+# room for the longest user and host
+PREFIX_ROOM = 1 + 1 + 10 + 1 + 63 + 1
+
+FALLBACKS = ['cp1255'] # that will be configurable and user-settable.
+
+# frequency (%) of the letters outside ascii in text of each script, 
+# latin is over accented letters only since plain ones are ascii
+LETTER_FREQUENCIES = {
+    'HEBREW': {
+        u'\u05d9': 11.1, u'\u05d5': 10.4, u'\u05d4': 9.9, u'\u05dc': 7.4, 
+        u'\u05d0': 6.3, u'\u05de': 5.0, u'\u05e8': 5.6, u'\u05ea': 5.3, 
+        u'\u05d1': 4.8, u'\u05e9': 4.5, u'\u05e0': 3.1, u'\u05d3': 2.9, 
+        u'\u05dd': 2.9, u'\u05e2': 2.8, u'\u05db': 2.7, u'\u05d7': 2.3, 
+        u'\u05e7': 2.0, u'\u05e4': 1.6, u'\u05df': 1.5, u'\u05e1': 1.0, 
+        u'\u05d2': 1.0, u'\u05e6': 0.9, u'\u05d6': 0.8, u'\u05d8': 0.8, 
+        u'\u05da': 0.6, u'\u05e3': 0.3, u'\u05e5': 0.2,
+    },
+    'CYRILLIC': {
+        u'\u043e': 10.4, u'\u0435': 8.1, u'\u0430': 7.7, u'\u0438': 7.0, 
+        u'\u043d': 6.4, u'\u0442': 6.0, u'\u0441': 5.2, u'\u0440': 4.5, 
+        u'\u0432': 4.3, u'\u043b': 4.2, u'\u043a': 3.3, u'\u043c': 3.1, 
+        u'\u0434': 2.8, u'\u043f': 2.7, u'\u0443': 2.5, u'\u044f': 1.9, 
+        u'\u044b': 1.8, u'\u044c': 1.7, u'\u0433': 1.6, u'\u0437': 1.6, 
+        u'\u0431': 1.5, u'\u0447': 1.4, u'\u0439': 1.2, u'\u0445': 0.9, 
+        u'\u0436': 0.9, u'\u0448': 0.7, u'\u044e': 0.6, u'\u0446': 0.5, 
+        u'\u0449': 0.3, u'\u044d': 0.3, u'\u0444': 0.3, u'\u0456': 0.5, 
+        u'\u0457': 0.3, u'\u0454': 0.2, u'\u0491': 0.1, u'\u0451': 0.1,
+        u'\u044a': 0.1,
+    },
+    'GREEK': {
+        u'\u03b1': 10.8, u'\u03bf': 8.4, u'\u03b9': 8.0, u'\u03b5': 7.6, 
+        u'\u03c4': 7.5, u'\u03bd': 6.8, u'\u03c3': 4.0, u'\u03b7': 4.6, 
+        u'\u03c1': 4.5, u'\u03c0': 4.0, u'\u03ba': 3.9, u'\u03c5': 3.8, 
+        u'\u03bc': 3.2, u'\u03bb': 2.6, u'\u03c2': 2.6, u'\u03c9': 1.6, 
+        u'\u03b4': 1.6, u'\u03b3': 1.6, u'\u03c7': 1.1, u'\u03b8': 1.1, 
+        u'\u03c6': 0.8, u'\u03b2': 0.6, u'\u03be': 0.4, u'\u03b6': 0.4, 
+        u'\u03c8': 0.1, u'\u03ac': 1.9, u'\u03ad': 1.4, u'\u03af': 1.7, 
+        u'\u03cc': 1.6, u'\u03ae': 1.1, u'\u03cd': 0.8, u'\u03ce': 0.8,
+    },
+    'ARABIC': {
+        u'\u0627': 12.5, u'\u0644': 11.0, u'\u064a': 6.5, u'\u0645': 6.2, 
+        u'\u0648': 5.7, u'\u0646': 5.6, u'\u0631': 4.4, u'\u062a': 3.8, 
+        u'\u0628': 3.8, u'\u0639': 3.5, u'\u062f': 3.0, u'\u0633': 2.7, 
+        u'\u0647': 2.6, u'\u0641': 2.6, u'\u0642': 2.4, u'\u0643': 2.4, 
+        u'\u0623': 2.3, u'\u062d': 1.9, u'\u0629': 2.7, u'\u062c': 1.3, 
+        u'\u0625': 1.1, u'\u0649': 1.0, u'\u0634': 1.0, u'\u0635': 0.9, 
+        u'\u0637': 0.8, u'\u062e': 0.8, u'\u0630': 0.7, u'\u062b': 0.5, 
+        u'\u0632': 0.5, u'\u0636': 0.5, u'\u063a': 0.4, u'\u0621': 0.4, 
+        u'\u0622': 0.3, u'\u0638': 0.2,
+    },
+    'LATIN': {
+        u'\xe9': 22.0, u'\xe1': 6.0, u'\xe0': 5.0, u'\xe8': 4.0, 
+        u'\xe7': 4.0, u'\xe3': 4.0, u'\xed': 4.0, u'\xf3': 4.0, 
+        u'\xea': 3.0, u'\xfc': 3.0, u'\xf6': 3.0, u'\xe4': 3.0, 
+        u'\xf1': 2.0, u'\xfa': 2.0, u'\xf4': 1.5, u'\xf5': 1.5, 
+        u'\xe2': 1.5, u'\xdf': 1.0, u'\xee': 0.5, u'\xef': 0.5, 
+        u'\xfb': 0.5, u'\xeb': 0.5, u'\xf9': 0.5, u'\xe5': 1.0, 
+        u'\xf8': 1.0, u'\xe6': 0.5, u'\u0142': 2.0, u'\u015b': 1.0, 
+        u'\u017c': 1.0, u'\u0105': 1.0, u'\u0119': 1.0, u'\u0107': 0.5, 
+        u'\u0144': 0.5, u'\u017a': 0.2, u'\u010d': 1.0, u'\u0161': 1.0, 
+        u'\u017e': 1.0, u'\u0159': 1.0, u'\u011b': 1.0, u'\u016f': 0.5, 
+        u'\u0151': 0.5, u'\u0171': 0.2, u'\u0103': 0.5, u'\u0219': 0.5,
+        u'\u021b': 0.5, u'\u015f': 0.5, u'\u0163': 0.3, u'\u0131': 0.5,
+        u'\u011f': 0.5, u'\xfd': 0.3,
+    },
+}
+UNLISTED_LETTER = 0.05 # % of letters not listed above
+UPPER_LETTER = 0.1 # times the frequency of the lowercase letter
+SYMBOL = 0.02 # % of punctuation and symbols
+CONTROL = 0.00001 # % of control characters and undefined bytes
+CASE_CHANGE = 0.01 # chance of an uppercase letter right after a lowercase
+MIXED_SCRIPT = 0.001 # chance of adjacent letters from different scripts
+MEMO_BONUS = 2.0 # log score added to the last encoding of the sender
+
+import os
+import re
+import sys
+import math
+import mmap
+import time
+import shutil
+import argparse
+import tempfile
+import unicodedata
+import multiprocessing
+from collections import OrderedDict
+
+try:
+    import xchat
+except ImportError:
+    # used from the command line, to repair logs
+    xchat = None
+
+_find_8bit = re.compile('[\x80-\xff]').search
+
+LOWER, UPPER, CASELESS = 'lower', 'upper', 'caseless'
+CASES = {'Ll': LOWER, 'Lu': UPPER, 'Lo': CASELESS}
+
+def split_utf8(text, limit):
+    """
+    Splits utf-8 text in pieces of at most limit bytes, on spaces if 
+    possible, never inside a character
+    """
+    pieces = []
+    while len(text) > limit:
+        cut = limit
+        while cut and '\x80' <= text[cut] <= '\xbf':
+            cut -= 1
+        space = text.rfind(' ', limit // 2, cut + 1)
+        if space > 0:
+            cut = space
+        pieces.append(text[:cut or limit])
+        text = text[cut or limit:]
+        if text[:1] == ' ':
+            text = text[1:]
+    pieces.append(text)
+    return pieces
+
+class ContextInfo(object):
+    """
+    Caches get_info() results for the last few contexts used, a copy of
+    clutterless' ContextInfo since each plugin is a single file.
+    """
+    EVENTS = ('Change Nick', 'Your Nick Changing', 'Focus Tab', 'You Join',
+              'You Part', 'You Part with Reason', 'You Kicked', 
+              'Open Context', 'Close Context', 'Server Connected', 
+              'Disconnected')
+
+    def __init__(self, size=8):
+        self.size = size
+        self._cache = []
+        for event in self.EVENTS:
+            xchat.hook_print(event, self.invalidate, priority=xchat.PRI_HIGHEST)
+
+    def get(self, *keys):
+        """Returns a tuple with the info for keys of the current context"""
+        context = xchat.get_context()
+        cache = self._cache
+        for i, (cached, info) in enumerate(cache):
+            if cached == context:
+                if i:
+                    cache.insert(0, cache.pop(i))
+                break
+        else:
+            info = {}
+            cache.insert(0, (context, info))
+            del cache[self.size:]
+        try:
+            return info[keys]
+        except KeyError:
+            result = info[keys] = tuple(context.get_info(key) for key in keys)
+            return result
+
+    def invalidate(self, word=None, word_eol=None, userdata=None):
+        del self._cache[:]
+
+class EncodingMemo(object):
+    """
+    Remembers the last fallback encoding that worked for each sender, 
+    forgetting the least recently seen senders beyond `size`.
+    """
+    def __init__(self, size=MEMO_SIZE):
+        self.size = size
+        self._memo = OrderedDict()
+
+    def get(self, sender):
+        encoding = self._memo.pop(sender, None)
+        if encoding is not None:
+            self._memo[sender] = encoding
+        return encoding
+
+    def set(self, sender, encoding):
+        self._memo.pop(sender, None)
+        self._memo[sender] = encoding
+        if len(self._memo) > self.size:
+            self._memo.popitem(last=False)
+
+    def forget(self, sender):
+        self._memo.pop(sender, None)
+
+def _byte_tables(encoding):
+    """
+    Returns, for each byte value in text of the encoding, the log of its 
+    frequency, its case (LOWER, UPPER, CASELESS or None if not a letter)
+    and the script of the letter
+    """
+    scores, cases, scripts = [], [], []
+    for byte in range(256):
+        try:
+            char = chr(byte).decode(encoding)
+        except UnicodeDecodeError:
+            char = None
+        category = unicodedata.category(char) if char else 'Cn'
+        if category in ('Ll', 'Lu', 'Lo'):
+            base = char.lower()
+            script = unicodedata.name(base, '').split(' ')[0]
+            freq = LETTER_FREQUENCIES.get(script, {}).get(base, UNLISTED_LETTER)
+            if char != base:
+                freq *= UPPER_LETTER
+        else:
+            script = None
+            if category[0] in 'LMNPSZ' or category == 'Cf':
+                freq = SYMBOL
+            else:
+                freq = CONTROL
+        scores.append(math.log(freq))
+        cases.append(CASES.get(category))
+        scripts.append(script)
+    return scores, cases, scripts
+
+class CharsetDetector(object):
+    """
+    Ranks 8bit encodings by how likely a piece of text is in each one.
+
+    The score of an encoding is the sum of the log frequency of the 
+    characters the non ascii bytes decode to, plus penalties for the 
+    pairs of adjacent letters from different scripts (including the ascii
+    ones) and for uppercase letters right after lowercase ones.  The 
+    frequencies, cases and scripts of the bytes are tabled once per 
+    encoding and the bytes and pairs are counted once per text, so each 
+    encoding only costs a few lookups per distinct byte.
+    """
+    _find_pairs = re.compile('(?=([\x00-\xff][\x80-\xff]|'
+                             '[\x80-\xff][\x00-\xff]))').findall
+
+    def __init__(self, encodings):
+        self.encodings = list(encodings)
+        self._tables = [_byte_tables(encoding) for encoding in self.encodings]
+
+    def scores(self, raw):
+        """Returns {encoding: score} for raw, higher is more likely"""
+        counts = [(ord(c), raw.count(c)) for c in set(raw) if c >= '\x80']
+        pairs = {}
+        for pair in self._find_pairs(raw):
+            pairs[pair] = pairs.get(pair, 0) + 1
+        pairs = [(ord(pair[0]), ord(pair[1]), count) 
+                 for pair, count in pairs.items()]
+        mixed_script = math.log(MIXED_SCRIPT)
+        case_change = math.log(CASE_CHANGE)
+        result = {}
+        for encoding, (scores, cases, scripts) in zip(self.encodings, 
+                                                      self._tables):
+            score = sum(scores[byte] * count for byte, count in counts)
+            for a, b, count in pairs:
+                if cases[a] is None or cases[b] is None:
+                    continue
+                if scripts[a] != scripts[b]:
+                    score += mixed_script * count
+                elif cases[a] is LOWER and cases[b] is UPPER:
+                    score += case_change * count
+            result[encoding] = score
+        return result
+
+    def rank(self, raw, preferred=None):
+        """Returns the encodings from the most to the least likely"""
+        scores = self.scores(raw)
+        if preferred in scores:
+            scores[preferred] += MEMO_BONUS
+        # ties are resolved by the configured order
+        return sorted(self.encodings, key=lambda encoding: -scores[encoding])
+
+class Converter(object):
+    """
+    Repairs text that xchat decoded with an 8bit charset: the original 
+    bytes are recovered and decoded as utf-8 or the most likely fallback.
+    Needs nothing from xchat, logs are repaired with it too.
+    """
+    def __init__(self, fallbacks=FALLBACKS):
+        self.fallbacks = fallbacks
+        self.memo = EncodingMemo()
+
+    def _get_fallbacks(self):
+        return self._detector.encodings
+
+    def _set_fallbacks(self, encodings):
+        self._detector = CharsetDetector(encodings)
+
+    fallbacks = property(_get_fallbacks, _set_fallbacks)
+        
+    def convert_piece(self, text, used_charset, sender=None):
+        raw = text.decode('utf-8').encode(used_charset)
+        try:
+            # always first, 8bit text is very unlikely to be valid utf-8
+            result = raw.decode('utf-8')
+        except UnicodeDecodeError:
+            result = self._decode_fallback(raw, used_charset, sender)
+        return result.encode('utf-8')
+
+    def _decode_fallback(self, raw, used_charset, sender):
+        """
+        Decodes with the most likely fallback encoding, the sender's last
+        one is favored so short lines don't flip between encodings
+        """
+        remembered = None if sender is None else self.memo.get(sender)
+        for encoding in self._detector.rank(raw, remembered):
+            try:
+                result = raw.decode(encoding)
+            except UnicodeDecodeError:
+                if encoding == remembered:
+                    self.memo.forget(sender)
+                continue
+            if sender is not None and encoding != remembered:
+                self.memo.set(sender, encoding)
+            return result
+        return raw.decode(used_charset)
+
+    def repair(self, line, used_charset):
+        """Converts a logged line, leaving it alone if it can't be done"""
+        if not _find_8bit(line):
+            return line
+        try:
+            return self.convert_piece(line, used_charset)
+        except UnicodeError:
+            # not written by xchat with that charset
+            return line
 
 class Plugin(object):
     def __init__(self):
 #        self._server_charset = {}
-        self.fallbacks = ['cp1255'] # that will be configurable and user-settable.
+        self.converter = Converter()
         self._ignore_receive = False
+        # lines typed, waiting to be sent together
+        self._outgoing = []
+        # lines resent through xchat, not to be queued again
         self._ignore_send = False
-        for event in EVENTS:
-            xchat.hook_print(event[0], self.convert, event, 
-                             priority=xchat.PRI_HIGHEST)
+        # lines being injected with RECV, not to be converted again
+        self._pending = set()
+        self._info = ContextInfo()
+        # /CHARSET changes the charset of the context, ours included
+        xchat.hook_command('CHARSET', self._info.invalidate,
+                           priority=xchat.PRI_HIGHEST)
+        if SERVER_MODE:
+            for command in SERVER_EVENTS:
+                xchat.hook_server(command, self.convert_line,
+                                  priority=xchat.PRI_HIGHEST)
+        else:
+            for event in EVENTS:
+                xchat.hook_print(event[0], self.convert, event, 
+                                 priority=xchat.PRI_HIGHEST)
 #        xchat.hook_command('', self.debug_print, 'all', priority=xchat.PRI_HIGHEST)
         xchat.hook_command('', self.fix_sends, priority=xchat.PRI_HIGHEST)
         for cmd in ('SAY', 'ME', 'MSG'):
             xchat.hook_command(cmd, self.fix_sendcmd, cmd, priority=xchat.PRI_HIGHEST)
 #        xchat.hook_command('SAY', self.fix_sends_say, priority=xchat.PRI_HIGH)
-        
-    def _convert_piece(self, text, used_charset):
-        raw = text.decode('utf-8').encode(used_charset)
-        try:
-            result = raw.decode('utf-8')
-        except UnicodeDecodeError:
-            for encoding in self.fallbacks:
-                try:
-                    result = raw.decode(encoding)
-                except UnicodeDecodeError:
-                    pass
-                else:
-                    break
-            else:
-                result = raw.decode(used_charset)
-        return result.encode('utf-8')
-                
+
     def convert(self, word, word_eol, userdata):
         if self._ignore_receive:
             return
-        event, pos = userdata
-        charset = xchat.get_info('charset')
+        event, pos, nick = userdata
+        charset, host = self._info.get('charset', 'host')
         if charset and charset.lower() in CHARSETS_8BIT:
+            sender = None if nick is None else (host, word[nick])
             for p in pos:
-                word[p] = self._convert_piece(word[p], charset)
+                word[p] = self.converter.convert_piece(word[p], charset, 
+                                                       sender)
             self._ignore_receive = True
             xchat.emit_print(event, *word)
             self._ignore_receive = False
             return xchat.EAT_ALL
         else:
-            host = xchat.get_info('host')
-            print MSG_WRONGENC % (charset, host)
-            xchat.command('CHARSET latin1')
-#            self._server_charset[host] = charset
+            self._wrong_charset(charset, host)
+
+    def convert_line(self, word, word_eol, userdata):
+        """Converts the last parameter of a server line and injects it"""
+        line = word_eol[0]
+        if line in self._pending:
+            return xchat.EAT_NONE
+        start = line.find(' :', 1)
+        # plain ascii needs no conversion
+        if start == -1 or not _find_8bit(line, start):
+            return xchat.EAT_NONE
+        charset, host = self._info.get('charset', 'host')
+        if not charset or charset.lower() not in CHARSETS_8BIT:
+            self._wrong_charset(charset, host)
+            return xchat.EAT_NONE
+        nick, sep, userhost = word[0][1:].partition('!')
+        sender = (host, nick) if sep else None
+        start += 2
+        fixed = line[:start] + self.converter.convert_piece(line[start:], 
+                                                            charset, sender)
+        if fixed == line:
+            return xchat.EAT_NONE
+        self._pending.add(fixed)
+        try:
+            xchat.command('RECV ' + fixed)
+        finally:
+            self._pending.discard(fixed)
+        return xchat.EAT_ALL
+
+    def _wrong_charset(self, charset, host):
+        print MSG_WRONGENC % (charset, host)
+        xchat.command('CHARSET latin1')
+#        self._server_charset[host] = charset
 
     def debug_print(self, word, word_eol, user_data):
         self._ignore_debug = True
@@ -134,22 +489,96 @@ class Plugin(object):
         self._ignore_debug = False
 
     def fix_sendcmd(self, word, word_eol, user_data):
+        """
+        Queues the message to be sent as utf-8.  xchat converts whatever
+        is sent to the 8bit charset, so the utf-8 bytes are sent decoded 
+        with the charset, and it writes them back unchanged.
+        """
         if self._ignore_send or len(word_eol) < 2:
             return
-        charset = xchat.get_info('charset')
-        xchat.command('CHARSET -quiet UTF-8')
-        self._ignore_send = True
-        xchat.command('%s %s' % (word[0], word_eol[1]))
-        self._ignore_send = False
-        xchat.command('CHARSET -quiet ' + charset)
+        charset, channel, server, nick = self._info.get('charset', 'channel', 
+                                                        'server', 'nick')
+        if not server or not charset or charset.lower() not in CHARSETS_8BIT:
+            return
+        if user_data == 'MSG':
+            if len(word_eol) < 3:
+                return
+            target, text = word[1], word_eol[2]
+        elif channel == server:
+            # server tab, let xchat complain
+            return
+        else:
+            target, text = channel, word_eol[1]
+        if target.startswith('='):
+            # DCC chats don't go through the server, xchat sends them
+            pieces = None
+        else:
+            # split like xchat would, the server cuts longer lines
+            room = (LINE_LIMIT - 2 - PREFIX_ROOM - len(nick or '') - 
+                    len('PRIVMSG %s :' % target))
+            if user_data == 'ME':
+                room -= len('\x01ACTION \x01')
+            try:
+                pieces = [(piece, piece.decode(charset).encode('utf-8'))
+                          for piece in split_utf8(text, room)]
+            except UnicodeDecodeError:
+                return
+        if not self._outgoing:
+            # a paste comes as many commands in a row, send them together
+            xchat.hook_timer(0, self._send_outgoing)
+        self._outgoing.append((xchat.get_context(), user_data, target, text, 
+                               pieces, charset))
         return xchat.EAT_ALL
+
+    def _send_outgoing(self, userdata=None):
+        """Sends each queued line with a single command, echoing it"""
+        nicks = []
+        for context, command, target, text, pieces, charset in self._outgoing:
+            if pieces is None:
+                self._resend(context, command, target, text, charset)
+                continue
+            for cached, nick in nicks:
+                if cached == context:
+                    break
+            else:
+                nick = context.get_info('nick')
+                nicks.append((context, nick))
+            for text, payload in pieces:
+                if command == 'ME':
+                    context.command('QUOTE PRIVMSG %s :\x01ACTION %s\x01' % (
+                        target, payload))
+                    context.emit_print('Your Action', nick, text)
+                else:
+                    context.command('QUOTE PRIVMSG %s :%s' % (target, payload))
+                    if command == 'MSG':
+                        context.emit_print('Message Send', target, text)
+                    else:
+                        context.emit_print('Your Message', nick, text)
+        del self._outgoing[:]
+        return False
         
+    def _resend(self, context, command, target, text, charset):
+        """
+        Has xchat send the line to a DCC chat, with the charset switched
+        to UTF-8
+        """
+        context.command('CHARSET -quiet UTF-8')
+        self._ignore_send = True
+        try:
+            if command == 'MSG':
+                context.command('MSG %s %s' % (target, text))
+            else:
+                context.command('%s %s' % (command, text))
+        finally:
+            self._ignore_send = False
+            context.command('CHARSET -quiet ' + charset)
+
     def fix_sends(self, word, word_eol, user_data):
         if self._ignore_send:
             return
         word = ['SAY']
         word_eol = [None, word_eol[0]]
-        return self.fix_sendcmd(word, word_eol, user_data)
+        return self.fix_sendcmd(word, word_eol, 'SAY')
 
 #    def fix_sends(self, word, word_eol, user_data):
 #        if self._ignore:
@@ -172,7 +601,110 @@ class Plugin(object):
             return
         return self.fix_sends([], word_eol[1:], user_data)
 
-p = Plugin()
+# the converter of each process repairing logs
+_converter = None
+
+def _init_worker(fallbacks):
+    global _converter
+    _converter = Converter(fallbacks)
+
+def repair_file(paths, charset):
+    """
+    Repairs the lines of a log into a temporary file next to the target,
+    renamed over it when complete.  Returns (source, lines, repaired).
+    """
+    source, target = paths
+    lines = repaired = 0
+    fd, tmpname = tempfile.mkstemp(prefix='.' + os.path.basename(target), 
+                                   dir=os.path.dirname(target) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            with open(source, 'rb') as f:
+                try:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # empty file
+                    data = None
+                if data is not None:
+                    try:
+                        for line in iter(data.readline, ''):
+                            fixed = _converter.repair(line, charset)
+                            lines += 1
+                            if fixed is not line:
+                                repaired += fixed != line
+                            output.write(fixed)
+                    finally:
+                        data.close()
+        shutil.copymode(source, tmpname)
+        if os.name == 'nt' and os.path.exists(target):
+            # windows won't rename over an existing file
+            os.remove(target)
+        os.rename(tmpname, target)
+    except:
+        os.remove(tmpname)
+        raise
+    return source, lines, repaired
+
+def _repair_file(args):
+    return repair_file(*args)
+
+def find_logs(paths, outdir=None):
+    """Yields (source, target) for the logs in paths"""
+    for path in paths:
+        if os.path.isdir(path):
+            sources = [os.path.join(root, name) 
+                       for root, dirs, files in os.walk(path)
+                       for name in sorted(files) if name.endswith('.log')]
+            base = path
+        else:
+            sources = [path]
+            base = os.path.dirname(path)
+        for source in sources:
+            if outdir is None:
+                yield source, source
+            else:
+                target = os.path.join(outdir, os.path.relpath(source, base))
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                yield source, target
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Repairs xchat logs of '
+        'text received in other encodings than the 8bit CHARSET in use.')
+    parser.add_argument('paths', nargs='+', 
+                        help='log files, or directories with *.log files')
+    parser.add_argument('-c', '--charset', default='latin1', 
+                        help='CHARSET xchat was using (default %(default)s)')
+    parser.add_argument('-f', '--fallbacks', default=','.join(FALLBACKS),
+                        help='encodings tried after utf-8, comma separated '
+                             '(default %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, 
+                        help='processes to use (default one per cpu)')
+    parser.add_argument('-o', '--output', help='directory for the repaired '
+                        'logs (default replaces them)')
+    args = parser.parse_args(argv)
+    start = time.time()
+    tasks = [(paths, args.charset) for paths in find_logs(args.paths, 
+                                                          args.output)]
+    pool = multiprocessing.Pool(args.jobs, _init_worker, 
+                                (args.fallbacks.split(','),))
+    total = total_repaired = 0
+    try:
+        for source, lines, repaired in pool.imap_unordered(_repair_file, 
+                                                           tasks):
+            print '%s: %d of %d lines repaired' % (source, repaired, lines)
+            total += lines
+            total_repaired += repaired
+    finally:
+        pool.close()
+        pool.join()
+    print '%d files, %d of %d lines repaired in %.1fs' % (len(tasks), 
+        total_repaired, total, time.time() - start)
+
+if xchat is not None:
+    p = Plugin()
+elif __name__ == '__main__':
+    main()
 
 #def _convert_piece(text):
 #    text = text.decode('utf-8')
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright© 2010 Clovis Fabricio Costa
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Logsearch
+Keeps a full text index of the conversations and searches it.
+
+Messages are written to an SQLite FTS5 table (FTS4 when the sqlite
+library has no FTS5) by a background thread, in batches.  Searches run
+on their own threads too, xchat only ever puts lines in a queue and
+prints the results.
+"""
+__module_name__ = "logsearch"
+__module_version__ = "0.1.0"
+__module_description__ = "Full text search of the conversations"
+
+import os
+import re
+import time
+import sqlite3
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import hexchat as xchat
+    CONFIGDIR = '~/.config/hexchat'
+except ImportError:
+    import xchat
+    CONFIGDIR = '~/.xchat2'
+
+DATABASE = os.path.expanduser(os.path.join(CONFIGDIR, 'logsearch.db'))
+BATCH_SIZE = 1000 # lines written per transaction, at most
+BATCH_DELAY = 2.0 # seconds waiting for more lines before writing a batch
+QUEUE_SIZE = 100000 # lines waiting to be written, more are dropped
+POLL_INTERVAL = 100 # ms between checks for search results
+SEARCH_LIMIT = 20
+
+EVENTS = (
+    'Channel Message',
+    'Channel Msg Hilight',
+    'Channel Action',
+    'Channel Action Hilight',
+    'Your Message',
+    'Your Action',
+    'Private Message to Dialog',
+    'Private Action to Dialog',
+)
+
+if bytes is str:
+    # python 2, xchat hands out utf-8 encoded strings
+    def to_text(text):
+        return text.decode('utf-8', 'replace')
+
+    def to_native(text):
+        return text.encode('utf-8')
+else:
+    def to_text(text):
+        return text
+    to_native = to_text
+
+def remove_formatting(text,
+        _remove_re_sub=re.compile(u"\x03(?:\\d{1,2}(?:,\\d{1,2})?)?|"
+                                  u"[\x02\x0f\x16\x1d\x1f]").sub):
+    return _remove_re_sub(u'', text)
+
+class ContextInfo(object):
+    """
+    Caches get_info() results for the last few contexts used, a copy of
+    clutterless' ContextInfo since each plugin is a single file.
+    """
+    EVENTS = ('Change Nick', 'Your Nick Changing', 'Focus Tab', 'You Join',
+              'You Part', 'You Part with Reason', 'You Kicked', 
+              'Open Context', 'Close Context', 'Server Connected', 
+              'Disconnected')
+
+    def __init__(self, size=8):
+        self.size = size
+        self._cache = []
+        for event in self.EVENTS:
+            xchat.hook_print(event, self.invalidate, priority=xchat.PRI_HIGHEST)
+
+    def get(self, *keys):
+        """Returns a tuple with the info for keys of the current context"""
+        context = xchat.get_context()
+        cache = self._cache
+        for i, (cached, info) in enumerate(cache):
+            if cached == context:
+                if i:
+                    cache.insert(0, cache.pop(i))
+                break
+        else:
+            info = {}
+            cache.insert(0, (context, info))
+            del cache[self.size:]
+        try:
+            return info[keys]
+        except KeyError:
+            result = info[keys] = tuple(context.get_info(key) for key in keys)
+            return result
+
+    def invalidate(self, word=None, word_eol=None, userdata=None):
+        del self._cache[:]
+
+class Index(object):
+    """The full text index, one instance per thread using it"""
+    SCHEMAS = (
+        ('fts5', 'CREATE VIRTUAL TABLE lines USING fts5('
+                 'time UNINDEXED, network, channel, nick, text)'),
+        ('fts4', 'CREATE VIRTUAL TABLE lines USING fts4('
+                 'time, network, channel, nick, text, notindexed=time)'),
+    )
+    SEARCHES = {
+        'fts5': "SELECT time, network, channel, nick, "
+                "highlight(lines, 4, '\x02', '\x02') FROM lines "
+                "WHERE lines MATCH ? ORDER BY rowid DESC LIMIT ?",
+        'fts4': "SELECT time, network, channel, nick, "
+                "snippet(lines, '\x02', '\x02', '...', 4, 64) FROM lines "
+                "WHERE lines MATCH ? ORDER BY docid DESC LIMIT ?",
+    }
+
+    def __init__(self, filename=DATABASE):
+        self.db = sqlite3.connect(filename)
+        # readers don't block the writer, and a crash loses at most the
+        # last batches
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.kind = self._create()
+
+    def _create(self):
+        row = self.db.execute("SELECT sql FROM sqlite_master "
+                              "WHERE name = 'lines'").fetchone()
+        if row is not None:
+            return 'fts5' if 'fts5' in row[0].lower() else 'fts4'
+        for kind, schema in self.SCHEMAS:
+            try:
+                with self.db:
+                    self.db.execute(schema)
+            except sqlite3.OperationalError:
+                continue
+            return kind
+        raise sqlite3.OperationalError('no full text search support in '
+                                       'sqlite ' + sqlite3.sqlite_version)
+
+    def write(self, lines):
+        with self.db:
+            self.db.executemany('INSERT INTO lines (time, network, channel, '
+                                'nick, text) VALUES (?, ?, ?, ?, ?)', lines)
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Returns the last limit lines matching query, newest first"""
+        return self.db.execute(self.SEARCHES[self.kind],
+                               (query, limit)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+class LogSearch(object):
+    def __init__(self):
+        self._lines = queue.Queue(QUEUE_SIZE)
+        self._results = queue.Queue()
+        self._searches = 0
+        self._poll_hook = None
+        self.dropped = 0
+        # why the writer thread stopped, told on the next message
+        self.failure = None
+        self._info = ContextInfo()
+        # opened here first so a broken database is reported at load
+        Index().close()
+        self._writer = threading.Thread(target=self._write, name='logsearch')
+        self._writer.daemon = True
+        self._writer.start()
+        for event in EVENTS:
+            xchat.hook_print(event, self.message)
+        xchat.hook_command('search', self.cmd_search, help=self.cmd_search.__doc__)
+        xchat.hook_unload(self.stop)
+
+    def message(self, word, word_eol, userdata):
+        if self.failure is not None:
+            print('logsearch: Stopped indexing: {}'.format(self.failure))
+            self.failure = None
+        if not self._writer.is_alive():
+            return
+        network, channel = self._info.get('network', 'channel')
+        try:
+            self._lines.put_nowait((time.time(), network, channel, word[0],
+                                    word[1]))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        """Writer thread, stores the queued lines in batches"""
+        try:
+            index = Index()
+            try:
+                self._write_batches(index)
+            finally:
+                index.close()
+        except Exception as e:
+            self.failure = e
+
+    def _write_batches(self, index):
+        running = True
+        while running:
+            batch = [self._lines.get()]
+            deadline = time.time() + BATCH_DELAY
+            while len(batch) < BATCH_SIZE and batch[-1] is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._lines.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                # unloading
+                running = False
+                batch.pop()
+            try:
+                index.write([(when, to_text(network or ''), 
+                              to_text(channel or ''),
+                              remove_formatting(to_text(nick)),
+                              remove_formatting(to_text(text)))
+                             for when, network, channel, nick, text in batch])
+            except sqlite3.Error:
+                self.dropped += len(batch)
+
+    def stop(self, userdata=None):
+        """Writes the lines still queued"""
+        if not self._writer.is_alive():
+            return
+        try:
+            self._lines.put(None, timeout=BATCH_DELAY)
+        except queue.Full:
+            # the writer is stuck or gone, the queued lines are lost
+            return
+        self._writer.join(BATCH_DELAY * 2)
+
+    def cmd_search(self, word, word_eol, userdata):
+        """
+        Usage: SEARCH [-<n>] <query>, searches the logged messages
+        and shows the last n (default 20) matches.  The query is in
+        SQLite full text syntax, e.g.: nick:bob "some phrase" OR word*
+        """
+        limit = SEARCH_LIMIT
+        if len(word) > 2 and word[1].startswith('-') and word[1][1:].isdigit():
+            limit = int(word[1][1:])
+            word, word_eol = word[1:], word_eol[1:]
+        if len(word) < 2:
+            print(self.cmd_search.__doc__)
+            return xchat.EAT_ALL
+        query = word_eol[1]
+        thread = threading.Thread(target=self._search, name='logsearch-query',
+                                  args=(xchat.get_context(), query, limit))
+        thread.daemon = True
+        thread.start()
+        self._searches += 1
+        if self._poll_hook is None:
+            self._poll_hook = xchat.hook_timer(POLL_INTERVAL, self._poll)
+        return xchat.EAT_ALL
+
+    def _search(self, context, query, limit):
+        """Search thread, queues the results for the main thread"""
+        start = time.time()
+        try:
+            index = Index()
+            try:
+                result = index.search(to_text(query), limit)
+            finally:
+                index.close()
+        except sqlite3.Error as e:
+            result = e
+        self._results.put((context, query, result, time.time() - start))
+
+    def _poll(self, userdata=None):
+        """Shows the results of the finished searches"""
+        while True:
+            try:
+                context, query, result, elapsed = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._searches -= 1
+            if isinstance(result, Exception):
+                context.prnt('logsearch: Search for {!r} failed: {}'.format(
+                    query, result))
+                continue
+            context.prnt('logsearch: {} results for {!r} in {:.0f}ms'.format(
+                len(result), query, elapsed * 1000))
+            for when, network, channel, nick, text in reversed(result):
+                context.prnt(to_native(u'{} {}@{} <{}> {}'.format(
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(when)),
+                    channel, network, nick, text)))
+        if self._searches:
+            return True
+        self._poll_hook = None
+        return False
+
+logsearch = LogSearch()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright© 2010 Clovis Fabricio Costa
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sendqueue
+Paces the raw lines sent by plugins so the server doesn't flood kick you.
+
+Lines sent with /RAW or /QUOTE (hybrid_decode sends everything you type
+that way) go through a queue per server that follows the flood control
+of the common ircds: each line costs two seconds plus a second per 120
+bytes, and the client may run ahead of the clock by some seconds.
+Messages too long for the 512 byte line limit are split, on spaces when
+possible and never inside a character.  Lines typed alone go before the
+rest of a paste.
+"""
+__module_name__ = "sendqueue"
+__module_version__ = "0.1.0"
+__module_description__ = "Flood control for the lines sent"
+
+import re
+import time
+import codecs
+from collections import deque
+
+try:
+    import hexchat as xchat
+except ImportError:
+    import xchat
+
+LINE_COST = 2.0 # seconds of penalty per line sent
+BYTES_PER_SECOND = 120 # and one more second per this many bytes
+BURST = 8.0 # seconds the penalty can run ahead of the clock
+PASTE_GAP = 0.1 # seconds, lines closer than this are part of a paste
+LINE_LIMIT = 512 # bytes per line, including the CRLF
+# our prefix as relayed by the server, ":nick!user@host ", with room for
+# the longest user and host
+PREFIX_ROOM = 1 + 1 + 10 + 1 + 63 + 1
+
+if bytes is str:
+    # python 2, xchat hands out utf-8 encoded strings
+    def to_text(text):
+        return text.decode('utf-8')
+
+    def to_native(text):
+        return text.encode('utf-8')
+else:
+    def to_text(text):
+        return text
+    to_native = to_text
+
+def wire_codec(charset):
+    """Returns the python codec for an xchat charset"""
+    try:
+        return codecs.lookup(charset).name
+    except (LookupError, TypeError):
+        # e.g. hexchat's "IRC" hybrid, which sends utf-8
+        return 'utf-8'
+
+def split_message(text, charset, limit):
+    """
+    Splits the unicode text in pieces of at most limit bytes as sent
+    with charset, on spaces if possible, never breaking a character.
+    """
+    codec = wire_codec(charset)
+    wire = text.encode(codec, 'replace')
+    if len(wire) <= limit:
+        return [text]
+    try:
+        # utf-8 double encoded in an 8bit charset, by hybrid_decode
+        chars, inner = wire.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        chars, inner = text, codec
+    pieces = []
+    while chars:
+        size = min(len(chars), limit)
+        while len(chars[:size].encode(inner, 'replace')) > limit:
+            size -= max(1, (len(chars[:size].encode(inner, 'replace')) -
+                            limit) // 4)
+        cut = size
+        if size < len(chars):
+            space = chars.rfind(u' ', size // 2, size + 1)
+            if space > 0:
+                cut = space
+        piece = chars[:cut].encode(inner, 'replace').decode(codec, 'replace')
+        pieces.append(piece)
+        chars = chars[cut:]
+        if chars[:1] == u' ':
+            chars = chars[1:]
+    return pieces
+
+class ServerQueue(object):
+    """Lines waiting to be sent to a server, and its flood control clock"""
+    __slots__ = ('clock', 'interactive', 'bulk', 'last', 'hook')
+
+    def __init__(self):
+        # time up to which the server counts us as busy
+        self.clock = 0.0
+        self.interactive = deque()
+        self.bulk = deque()
+        self.last = 0.0
+        self.hook = None
+
+    def __len__(self):
+        return len(self.interactive) + len(self.bulk)
+
+    def __iter__(self):
+        for lines in (self.interactive, self.bulk):
+            for context, line in lines:
+                yield line
+
+class SendQueue(object):
+    _match_message = re.compile(r'^((?:PRIVMSG|NOTICE) (\S+) :)(.*)$',
+                                re.IGNORECASE | re.DOTALL).match
+
+    def __init__(self, time_func=time.time):
+        self._time = time_func
+        self._servers = {}
+        self._sending = False
+        for command in ('RAW', 'QUOTE'):
+            xchat.hook_command(command, self.raw, priority=xchat.PRI_HIGHEST)
+        xchat.hook_command('sendqueue', self.cmd_sendqueue,
+                           help=self.cmd_sendqueue.__doc__)
+        xchat.hook_print('Disconnected', self.disconnected)
+
+    def raw(self, word, word_eol, userdata):
+        if self._sending or len(word_eol) < 2:
+            return xchat.EAT_NONE
+        context = xchat.get_context()
+        host = context.get_info('host')
+        if not host:
+            return xchat.EAT_NONE
+        queue = self._servers.get(host)
+        if queue is None:
+            queue = self._servers[host] = ServerQueue()
+        now = self._time()
+        line = word_eol[1]
+        match = self._match_message(line)
+        if match is None:
+            # anything but a message is urgent
+            lines, target = [line], queue.interactive
+        else:
+            lines = self._split(context, *match.groups())
+            target = queue.bulk if now - queue.last < PASTE_GAP else queue.interactive
+        queue.last = now
+        target.extend((context, line) for line in lines)
+        if queue.hook is None:
+            self._drain(host)
+        return xchat.EAT_ALL
+
+    def _split(self, context, head, receiver, text):
+        """Splits a message to fit the line limit"""
+        limit = (LINE_LIMIT - 2 - PREFIX_ROOM -
+                 len(context.get_info('nick') or '') - len(head))
+        text = to_text(text)
+        ctcp = u''
+        if text.startswith(u'\x01ACTION ') and text.endswith(u'\x01'):
+            ctcp, text = u'\x01ACTION ', text[8:-1]
+            limit -= 9
+        pieces = split_message(text, context.get_info('charset'), limit)
+        if ctcp:
+            pieces = [ctcp + piece + u'\x01' for piece in pieces]
+        return [head + to_native(piece) for piece in pieces]
+
+    def _cost(self, line):
+        return LINE_COST + len(line) / float(BYTES_PER_SECOND)
+
+    def _drain(self, host):
+        """Sends the lines the flood control allows, schedules the rest"""
+        queue = self._servers.get(host)
+        if queue is None:
+            return False
+        queue.hook = None
+        now = self._time()
+        while queue:
+            lines = queue.interactive or queue.bulk
+            context, line = lines[0]
+            clock = max(queue.clock, now)
+            cost = self._cost(line)
+            wait = clock + cost - now - BURST
+            if wait > 0:
+                queue.hook = xchat.hook_timer(int(wait * 1000) + 1,
+                                              self._drain, host)
+                break
+            lines.popleft()
+            queue.clock = clock + cost
+            self._sending = True
+            try:
+                context.command('QUOTE ' + line)
+            finally:
+                self._sending = False
+        return False
+
+    def disconnected(self, word, word_eol, userdata):
+        queue = self._servers.pop(xchat.get_info('host'), None)
+        if queue is not None and queue.hook is not None:
+            xchat.unhook(queue.hook)
+
+    def cmd_sendqueue(self, word, word_eol, userdata):
+        """
+        Usage: SENDQUEUE [CLEAR], shows the lines waiting to be sent to
+        each server, CLEAR drops those of pastes for the current server.
+        """
+        if len(word) > 1 and word[1].upper() == 'CLEAR':
+            queue = self._servers.get(xchat.get_info('host'))
+            count = len(queue.bulk) if queue else 0
+            if count:
+                queue.bulk.clear()
+            print('sendqueue: Dropped {} lines'.format(count))
+        elif not any(self._servers.values()):
+            print('sendqueue: Nothing waiting to be sent')
+        else:
+            now = self._time()
+            for host, queue in sorted(self._servers.items()):
+                if queue:
+                    busy = (max(queue.clock - now, 0) - BURST + 
+                            sum(self._cost(line) for line in queue))
+                    print('sendqueue: {}: {} lines ({} pasted), {:.0f}s to '
+                          'send'.format(host, len(queue), len(queue.bulk),
+                                        max(busy, 0)))
+        return xchat.EAT_ALL
+
+sendqueue = SendQueue()